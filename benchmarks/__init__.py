@@ -0,0 +1,7 @@
+# Copyright (c) 2010 Thomas Kongevold Adamcik
+# Released under MIT license, see COPYING file
+
+'''
+Benchmarks for pycat, run them from the top of the repository, e.g.
+python benchmarks/relay.py --output results.json
+'''
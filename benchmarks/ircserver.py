@@ -0,0 +1,181 @@
+# Copyright (c) 2010 Thomas Kongevold Adamcik
+# Released under MIT license, see COPYING file
+
+'''
+Fake IRC server that runs on the same reactor as the pycat under test, so a
+benchmark is one process with one event loop and no threads to skew timings.
+'''
+
+import errno
+import socket
+
+from pycat import TokenBucket
+
+class ServerClient(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.nick = '*'
+        self.buffer = ''
+        self.output = ''
+        self.bucket = None
+
+class FakeServer(object):
+    '''
+    Welcomes whoever connects, answers JOIN with NAMES listing user nicks
+    named user0, user1 and so on, and hands every PRIVMSG and NOTICE to
+    callback. Clients sending faster than flood_rate lines per second, after
+    a burst of flood_burst lines, get an excess flood error and are dropped
+    like a real server would.
+    '''
+
+    NAMES_LENGTH = 400
+
+    def __init__(self, reactor, users=10, callback=None, flood_rate=None,
+                 flood_burst=10):
+        self.reactor = reactor
+        self.users = ['user%d' % i for i in range(users)]
+        self.callback = callback
+        self.flood_rate = flood_rate
+        self.flood_burst = flood_burst
+
+        self.clients = {}
+        self.received = 0
+        self.flooded = 0
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.setblocking(0)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(16)
+        self.port = self.listener.getsockname()[1]
+
+        self.reactor.register(self.listener, self.handle_listener)
+
+    def handle_listener(self, sock):
+        try:
+            conn, addr = sock.accept()
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+
+        conn.setblocking(0)
+        client = ServerClient(conn)
+
+        if self.flood_rate:
+            client.bucket = TokenBucket(self.flood_rate, self.flood_burst)
+
+        self.clients[conn] = client
+        self.reactor.register(conn, self.handle_client)
+
+    def handle_client(self, sock):
+        client = self.clients[sock]
+
+        try:
+            data = sock.recv(65536)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ''
+
+        if not data:
+            self.close(client)
+            return
+
+        lines = (client.buffer + data).split('\r\n')
+        client.buffer = lines.pop()
+
+        for line in lines:
+            if sock not in self.clients:
+                break
+            elif client.bucket and not client.bucket.consume():
+                self.flooded += 1
+                self.send(client, 'ERROR :Closing Link: (Excess Flood)')
+                self.flush(client)
+                self.close(client)
+            else:
+                self.handle_line(client, line)
+
+    def handle_writable(self, sock):
+        self.flush(self.clients[sock])
+
+    def handle_line(self, client, line):
+        self.received += 1
+        parts = line.split(' ', 2)
+        command = parts[0].upper()
+
+        if command == 'NICK':
+            client.nick = parts[1]
+        elif command == 'USER':
+            self.send(client, ':fake 001 %s :Welcome' % client.nick)
+            self.send(client, ':fake 005 %s CASEMAPPING=rfc1459 '
+                'TARGMAX=PRIVMSG:4 :are supported' % client.nick)
+        elif command == 'JOIN':
+            for channel in parts[1].split(','):
+                self.join(client, channel)
+        elif command == 'PING':
+            self.send(client, ':fake PONG fake :%s' % parts[1])
+        elif command in ('PRIVMSG', 'NOTICE') and len(parts) == 3:
+            if self.callback:
+                self.callback(parts[1], parts[2][1:])
+        elif command == 'QUIT':
+            self.close(client)
+
+    def join(self, client, channel):
+        self.send(client, ':%s!cat@fake JOIN :%s' % (client.nick, channel))
+
+        names = [client.nick]
+        length = 0
+
+        for nick in self.users:
+            if length + len(nick) > self.NAMES_LENGTH:
+                self.names(client, channel, names)
+                names, length = [], 0
+            names.append(nick)
+            length += len(nick) + 1
+
+        self.names(client, channel, names)
+        self.send(client, ':fake 366 %s %s :End of /NAMES list.' %
+            (client.nick, channel))
+
+    def names(self, client, channel, names):
+        self.send(client, ':fake 353 %s = %s :%s' % (client.nick, channel,
+            ' '.join(names)))
+
+    def say(self, source, target, message):
+        '''Send message to every client as if source said it in target'''
+
+        for client in self.clients.values():
+            self.send(client, ':%s!user@fake PRIVMSG %s :%s' %
+                (source, target, message))
+
+    def send(self, client, line):
+        client.output += line + '\r\n'
+        self.flush(client)
+
+    def flush(self, client):
+        try:
+            sent = client.sock.send(client.output)
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                client.output = ''
+            sent = 0
+
+        client.output = client.output[sent:]
+
+        if client.output:
+            self.reactor.register_writer(client.sock, self.handle_writable)
+        else:
+            self.reactor.unregister_writer(client.sock)
+
+    def close(self, client):
+        self.reactor.unregister(client.sock)
+        client.sock.close()
+        del self.clients[client.sock]
+
+    def stop(self):
+        for client in self.clients.values():
+            self.close(client)
+
+        self.reactor.unregister(self.listener)
+        self.listener.close()
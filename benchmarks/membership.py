@@ -0,0 +1,89 @@
+#! /usr/bin/python
+# Copyright (c) 2010 Thomas Kongevold Adamcik
+# Released under MIT license, see COPYING file
+
+'''
+Compare the cost of validating listener targets as channels grow, using the
+users() list lookups pycat used to do and the membership index.
+
+Run from the top of the repository: python benchmarks/membership.py
+'''
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ircbot import Channel
+from pycat import PyCat, Relay, decode, encode
+
+SIZES = (10, 100, 1000, 2000, 5000)
+LINES = 2000
+
+def list_parse_targets(bot, line):
+    '''parse_targets as it was before the membership index'''
+
+    if encode(bot.channel) not in bot.channels:
+        return [], line
+
+    allowed_targets = bot.channels[encode(bot.channel)].users()
+    allowed_targets = map(decode, allowed_targets)
+    allowed_targets.append(bot.channel)
+
+    targets = []
+    parts = line.split(' ')
+
+    if '@' in parts[0] or '#' in parts[0]:
+        valid = lambda s: s[0] in '#@'
+        strip = lambda s: s.lstrip('@')
+        allowed = lambda s: s in allowed_targets
+
+        targets = parts.pop(0).split(',')
+        targets = filter(valid, targets)
+        targets = map(strip, targets)
+        targets = filter(allowed, targets)
+
+    return targets, ' '.join(parts)
+
+def index_parse_targets(relay, line):
+    '''parse_targets with the membership index, for the first network'''
+
+    targets, message = relay.parse_targets(line)
+    return targets.get(relay.networks.values()[0], []), message
+
+def setup(size):
+    relay = Relay()
+    bot = PyCat(relay, 'localhost', [('localhost', 6667, None)], 'cat', 'cat',
+        ['#pycat'])
+    relay.add_network(bot)
+
+    bot.channels['#pycat'] = Channel()
+    bot.membership.reset(u'#pycat')
+
+    for i in range(size):
+        nick = 'user%d' % i
+        bot.channels['#pycat'].add_user(nick)
+        bot.membership.join(u'#pycat', decode(nick))
+
+    return relay, bot
+
+def main():
+    print '%8s %14s %14s' % ('users', 'list us/line', 'index us/line')
+
+    for size in SIZES:
+        relay, bot = setup(size)
+        line = u'@user%d,@user0,@nobody,#pycat Hello all' % (size - 1)
+
+        assert list_parse_targets(bot, line) == \
+            index_parse_targets(relay, line)
+
+        old = timeit.Timer(lambda: list_parse_targets(bot, line))
+        new = timeit.Timer(lambda: index_parse_targets(relay, line))
+
+        print '%8d %14.2f %14.2f' % (size,
+            min(old.repeat(3, LINES)) / LINES * 1e6,
+            min(new.repeat(3, LINES)) / LINES * 1e6)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,441 @@
+#! /usr/bin/python
+# Copyright (c) 2010 Thomas Kongevold Adamcik
+# Released under MIT license, see COPYING file
+
+'''
+Drive a pycat connected to the fake IRC server in ircserver.py and measure,
+as channel size, listener client count and payload size grow:
+
+- relay latency from listener clients to the server, and lines per second
+- lines per second through handle_send_buffer and the time spent in it
+- script commands answered per second, both forking and with --workers
+- fds opened and RSS of the process
+
+Results are written as JSON so a later run can be compared to them.
+
+Run from the top of the repository:
+    python benchmarks/relay.py --output before.json
+    python benchmarks/relay.py --output after.json --compare before.json
+'''
+
+import errno
+import json
+import logging
+import os
+import platform
+import socket
+import sys
+import time
+
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from benchmarks.ircserver import FakeServer
+from pycat import PyCat, Relay, VERSION, monotonic
+
+CHANNEL = u'#bench'
+STUB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stub.py')
+
+# Each scenario changes one of these, the first scenario is the baseline
+BASELINE = {'users': 100, 'clients': 1, 'payload': 64}
+SCALES = (('users', (10, 1000, 10000)),
+          ('clients', (10, 100)),
+          ('payload', (16, 256, 1024)))
+
+PERCENTILES = (50, 90, 99)
+
+def scenarios():
+    yield dict(BASELINE)
+
+    for key, values in SCALES:
+        for value in values:
+            scenario = dict(BASELINE)
+            scenario[key] = value
+            yield scenario
+
+def percentile(values, percent):
+    '''Nearest rank percentile of sorted values'''
+
+    if not values:
+        return None
+
+    rank = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+def open_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+def rss_kb():
+    for line in open('/proc/self/status'):
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1])
+    return None
+
+class Sender(object):
+    def __init__(self, sock, lines):
+        self.sock = sock
+        self.remaining = lines
+        self.output = ''
+
+class Bench(object):
+    '''A relay with one network, connected to its own fake server'''
+
+    # Bytes a sender buffers at a time, lines are stamped as they are added
+    # so keep this small to not count our own buffering as relay latency.
+    SEND_SIZE = 4096
+
+    def __init__(self, users, options):
+        self.options = options
+        self.last_nick = u'user%d' % (users - 1)
+
+        self.latencies = []
+        self.received = 0
+        self.replies = 0
+        self.done = False
+
+        self.senders = {}
+        self.sequence = 0
+
+        self.relay = Relay([('tcp', ('127.0.0.1', 0))],
+            script=[sys.executable, STUB], max_scripts=options.max_scripts,
+            script_queue=options.commands)
+        self.reactor = self.relay.reactor
+
+        self.server = FakeServer(self.reactor, users, self.handle_privmsg,
+            options.flood_rate, options.flood_burst)
+
+        self.bot = PyCat(self.relay, 'bench',
+            [('127.0.0.1', self.server.port, None)], 'cat', 'cat', [CHANNEL],
+            rate=options.rate, burst=options.burst)
+        self.relay.add_network(self.bot)
+
+    def start(self):
+        self.bot.start()
+        self.relay.running = True
+
+        return self.run_until(lambda: self.bot.membership.contains(CHANNEL,
+            self.last_nick))
+
+    def stop(self):
+        self.close_senders()
+        self.relay.running = False
+        self.relay.stop()
+        self.server.stop()
+
+    def run_until(self, condition, timeout=None):
+        '''Run the reactor until condition is true, False on timeout'''
+
+        deadline = monotonic() + (timeout or self.options.timeout)
+        # Makes sure the reactor wakes up in time to give up
+        timer = self.reactor.call_later(deadline - monotonic(), lambda: None)
+
+        try:
+            while not condition():
+                if monotonic() >= deadline:
+                    return False
+                self.reactor.run_once()
+        finally:
+            self.reactor.cancel(timer)
+
+        return True
+
+    def listener_address(self):
+        for sock, handler in self.reactor.dispatchers.items():
+            if handler == self.relay.handle_listener:
+                return sock.getsockname()
+
+    ## Measurements ##
+    def measure_relay(self, clients, lines, payload):
+        '''Send lines spread over clients through the listener'''
+
+        address = self.listener_address()
+        self.target = u'@%s' % self.last_nick
+        self.padding = 'x' * payload
+        self.latencies = []
+
+        start = monotonic()
+
+        for i in range(clients):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect(address)
+            sock.setblocking(0)
+
+            share = lines // clients + (i < lines % clients)
+            self.senders[sock] = Sender(sock, share)
+            self.reactor.register(sock, self.handle_sender_readable)
+            self.reactor.register_writer(sock, self.handle_sender)
+
+        finished = self.run_until(lambda: len(self.latencies) >= lines)
+        seconds = monotonic() - start
+        fds = open_fds()
+
+        self.close_senders()
+        self.latencies.sort()
+
+        result = {'lines': lines, 'seconds': seconds,
+                  'lines_per_second': len(self.latencies) / seconds,
+                  'dropped': self.bot.send_buffer.dropped,
+                  'latency_max_ms': self.latencies and \
+                      self.latencies[-1] * 1000,
+                  'fds': fds, 'timeout': not finished}
+
+        for percent in PERCENTILES:
+            value = percentile(self.latencies, percent)
+            result['latency_p%d_ms' % percent] = value and value * 1000
+
+        return result
+
+    def measure_send_buffer(self, lines, payload):
+        '''Queue lines straight into the send queue and time the drain'''
+
+        spent = [0.0]
+        handle_send_buffer = self.bot.handle_send_buffer
+
+        def timed():
+            started = monotonic()
+            handle_send_buffer()
+            spent[0] += monotonic() - started
+
+        # queue_raw and handle_send_buffer schedule through the instance
+        self.bot.handle_send_buffer = timed
+
+        message = u'x' * payload
+        received = self.received
+        self.done = False
+
+        start = monotonic()
+
+        for i in range(lines):
+            self.bot.send_message(message, [CHANNEL])
+        self.bot.send_message(u'done', [CHANNEL])
+
+        finished = self.run_until(lambda: self.done)
+        seconds = monotonic() - start
+
+        del self.bot.handle_send_buffer
+
+        sent = max(self.received - received - 1, 0)
+
+        return {'lines': sent, 'seconds': seconds,
+                'lines_per_second': sent / seconds,
+                'handler_us_per_line': spent[0] / max(sent, 1) * 1e6,
+                'timeout': not finished}
+
+    def measure_scripts(self, commands, workers=0):
+        '''Say commands in the channel and wait for the stub's replies'''
+
+        if workers:
+            self.relay.worker_count = workers
+            self.relay.start_workers()
+
+        replies = self.replies
+        start = monotonic()
+
+        for i in range(commands):
+            self.server.say('user0', CHANNEL, '!bench %d' % i)
+
+        finished = self.run_until(lambda: self.replies - replies >= commands)
+        seconds = monotonic() - start
+
+        return {'commands': commands, 'seconds': seconds,
+                'commands_per_second': (self.replies - replies) / seconds,
+                'workers': workers, 'timeout': not finished}
+
+    ## Event handlers ##
+    def handle_privmsg(self, target, message):
+        self.received += 1
+
+        if message == 'done':
+            self.done = True
+        elif message.startswith('reply '):
+            self.replies += 1
+        else:
+            try:
+                stamp = float(message.split(' ', 2)[1])
+            except (IndexError, ValueError):
+                return # Not stamped, either padding or a split off part
+            self.latencies.append(monotonic() - stamp)
+
+    def handle_sender(self, sock):
+        sender = self.senders[sock]
+
+        while sender.remaining and len(sender.output) < self.SEND_SIZE:
+            self.sequence += 1
+            sender.output += '%s %d %.6f %s\n' % (self.target, self.sequence,
+                monotonic(), self.padding)
+            sender.remaining -= 1
+
+        try:
+            sent = sock.send(sender.output)
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            sent = 0
+
+        sender.output = sender.output[sent:]
+
+        if not sender.output and not sender.remaining:
+            self.reactor.unregister_writer(sock)
+
+    def handle_sender_readable(self, sock):
+        if not sock.recv(4096):
+            self.close_sender(sock)
+
+    def close_sender(self, sock):
+        self.reactor.unregister(sock)
+        sock.close()
+        del self.senders[sock]
+
+    def close_senders(self):
+        for sock in self.senders.keys():
+            self.close_sender(sock)
+
+def run(scenario, options):
+    fds = open_fds()
+    bench = Bench(scenario['users'], options)
+
+    try:
+        if not bench.start():
+            return {'scenario': scenario, 'error': 'could not join %s' %
+                CHANNEL}
+
+        result = {'scenario': scenario}
+        result['relay'] = bench.measure_relay(scenario['clients'],
+            options.lines, scenario['payload'])
+        result['relay']['fds'] -= fds
+        result['send_buffer'] = bench.measure_send_buffer(options.lines,
+            scenario['payload'])
+        result['scripts'] = bench.measure_scripts(options.commands)
+        result['coprocess'] = bench.measure_scripts(options.commands,
+            options.workers)
+        result['flooded'] = bench.server.flooded
+        result['rss_kb'] = rss_kb()
+    finally:
+        bench.stop()
+
+    return result
+
+def describe(scenario):
+    return ' '.join('%s=%s' % item for item in sorted(scenario.items()))
+
+def report(result):
+    print describe(result['scenario'])
+
+    if 'error' in result:
+        print '  error: %s' % result['error']
+        return
+
+    relay = result['relay']
+    print '  relay:       %8.0f lines/s  p50 %.2fms  p99 %.2fms  %d fds%s' % (
+        relay['lines_per_second'], relay['latency_p50_ms'] or 0,
+        relay['latency_p99_ms'] or 0, relay['fds'],
+        relay['timeout'] and '  (timed out)' or '')
+
+    send_buffer = result['send_buffer']
+    print '  send buffer: %8.0f lines/s  %.2fus/line in handler%s' % (
+        send_buffer['lines_per_second'], send_buffer['handler_us_per_line'],
+        send_buffer['timeout'] and '  (timed out)' or '')
+
+    for name in ('scripts', 'coprocess'):
+        scripts = result[name]
+        print '  %-12s %8.1f commands/s%s' % (name + ':',
+            scripts['commands_per_second'],
+            scripts['timeout'] and '  (timed out)' or '')
+
+    print '  rss:         %8d kB' % result['rss_kb']
+
+    if result['flooded']:
+        print '  disconnected for flooding %d times' % result['flooded']
+
+def compare(old, new):
+    '''Print how each measurement changed since an earlier run'''
+
+    key = lambda scenario: tuple(sorted(scenario.items()))
+    before = dict((key(r['scenario']), r) for r in old['results'])
+
+    print '%-36s %-32s %12s %12s %8s' % ('scenario', 'measurement', 'before',
+        'after', 'change')
+
+    for result in new['results']:
+        previous = before.get(key(result['scenario']))
+
+        if not previous:
+            continue
+
+        for phase in ('relay', 'send_buffer', 'scripts', 'coprocess'):
+            for name, value in sorted(result.get(phase, {}).items()):
+                old_value = previous.get(phase, {}).get(name)
+
+                if not isinstance(value, float) or not old_value or \
+                        name == 'seconds':
+                    continue
+
+                print '%-36s %-32s %12.2f %12.2f %+7.1f%%' % (
+                    describe(result['scenario']), '%s.%s' % (phase, name),
+                    old_value, value, (value - old_value) / old_value * 100)
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--output', metavar='path',
+        help='write results as JSON to path')
+    parser.add_option('--compare', metavar='path',
+        help='compare results with an earlier run written by --output')
+    parser.add_option('--lines', type='int', default=2000, metavar='count',
+        help='lines to relay per scenario [default: %default]')
+    parser.add_option('--commands', type='int', default=100, metavar='count',
+        help='script commands to send per scenario [default: %default]')
+    parser.add_option('--workers', type='int', default=4, metavar='count',
+        help='script workers for the coprocess run [default: %default]')
+    parser.add_option('--max-scripts', type='int', default=10,
+        metavar='count', help='scripts to run at the same time '
+        '[default: %default]')
+    parser.add_option('--rate', type='float', default=100000,
+        metavar='lines', help='lines per second pycat may send to the '
+        'server [default: %default]')
+    parser.add_option('--burst', type='int', default=50, metavar='lines',
+        help='lines pycat may send in a burst [default: %default]')
+    parser.add_option('--flood-rate', type='float', metavar='lines',
+        help='lines per second the server allows before disconnecting')
+    parser.add_option('--flood-burst', type='int', default=10,
+        metavar='lines', help='lines the server allows in a burst '
+        '[default: %default]')
+    parser.add_option('--timeout', type='float', default=60,
+        metavar='seconds', help='give up on a measurement after this long '
+        '[default: %default]')
+    parser.add_option('-v', '--verbose', action='store_true',
+        help='show what pycat logs')
+
+    options, args = parser.parse_args()
+
+    if options.verbose:
+        level = logging.INFO
+    else:
+        level = logging.CRITICAL
+
+    logging.basicConfig(level=level, format='[%(asctime)s] %(message)s')
+
+    results = []
+
+    for scenario in scenarios():
+        result = run(scenario, options)
+        report(result)
+        results.append(result)
+
+    output = {'version': VERSION,
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'options': options.__dict__,
+              'results': results}
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as f:
+            compare(json.load(f), output)
+
+if __name__ == '__main__':
+    main()
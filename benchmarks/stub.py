@@ -0,0 +1,33 @@
+#! /usr/bin/python
+# Copyright (c) 2010 Thomas Kongevold Adamcik
+# Released under MIT license, see COPYING file
+
+'''
+Script that answers every command right away, used by the benchmarks to
+time dispatching rather than whatever a real script would be doing.
+'''
+
+import json
+import sys
+
+def reply(message):
+    return 'reply %s' % message.split(' ', 1)[-1]
+
+def main():
+    if sys.argv[1:] == ['--config']:
+        print 'match = ^!'
+    elif sys.argv[1:] == ['--coprocess']:
+        for line in iter(sys.stdin.readline, ''):
+            request = json.loads(line)
+            sys.stdout.write(json.dumps({'id': request['id'],
+                'message': reply(request['message'])}) + '\n')
+            sys.stdout.write(json.dumps({'id': request['id'],
+                'done': True}) + '\n')
+            sys.stdout.flush()
+    elif len(sys.argv) == 5:
+        print reply(sys.argv[4])
+    else:
+        print 'Usage: %s nick target source "message"' % sys.argv[0]
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#! /usr/bin/python
+# Copyright (c) 2010 Thomas Kongevold Adamcik
+# Released under MIT license, see COPYING file
+
+'''
+Compare the text functions every line goes through with the versions pycat
+used to have, for plain ASCII, UTF-8 and colored lines.
+
+Run from the top of the repository: python benchmarks/text.py
+'''
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pycat import decode, decode_lines, encode, encode_lines, split_utf8, \
+    strip_unprintable
+
+LINES = {
+    'ascii': 'Build 1234 of pycat finished in 42 seconds, all tests passed',
+    'utf-8': 'Bygg 1234 av pycat ferdig p\xc3\xa5 42 sekunder, bl\xc3\xa5tt',
+    'colors': '\x02Build\x02 1234 \x0303,01passed\x03 in \x1fhalf\x1f a '
+              'minute \x1B[1mok\x1B[0m',
+}
+
+BATCH = 20
+REPEAT = 20000
+
+def old_strip_unprintable(string):
+    '''strip_unprintable() before the translate fast path'''
+
+    regexes = ('\x1B\[.*?[\x00-\x1F\x40-\x7E]', # ECMA-48
+               '\x03\d\d?(?:,\d\d?)?', # IRC colors
+               '[\x03\x16\x02\x1f\x0f]') # Other unprintables
+
+    return re.sub('|'.join(regexes), '', string)
+
+def timed(function, *args):
+    timer = timeit.Timer(lambda: function(*args))
+    return min(timer.repeat(3, REPEAT)) / REPEAT * 1e6
+
+def compare(name, old, new, *args):
+    assert old(*args) == new(*args)
+    print '%-24s %12.2f %12.2f' % (name, timed(old, *args), timed(new, *args))
+
+def main():
+    print '%-24s %12s %12s' % ('us/call', 'old', 'new')
+
+    for kind, line in sorted(LINES.items()):
+        lines = [line] * BATCH
+        unicode_lines = map(decode, lines)
+
+        compare('strip %s' % kind, old_strip_unprintable, strip_unprintable,
+            line)
+        compare('decode %d %s' % (BATCH, kind), lambda l: map(decode, l),
+            decode_lines, lines)
+        compare('encode %d %s' % (BATCH, kind), lambda l: map(encode, l),
+            encode_lines, unicode_lines)
+
+    for kind, line in sorted(LINES.items()):
+        data = line * 30
+        print '%-24s %12s %12.2f' % ('split %d %s' % (len(data), kind), '-',
+            timed(split_utf8, data, 400))
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,8 @@
 # Copyright (c) 2010 Thomas Kongevold Adamcik
 # Released under MIT license, see COPYING file
 
-USAGE = 'Usage: %prog server[:port][,server[:port]] nickname channel [options]'
+USAGE = 'Usage: %prog server[:port][,server[:port]] nickname channel[,channel] ' \
+    '[options]'
 
 VERSION = 'pycat - http://github.com/adamcik/pycat'
 
@@ -18,165 +19,4283 @@ Examples:
     %prog irc.mynet.prv:7777/secretpw cat '#pycat'
   Connect to irc.freenode.net, listen on port 8000 on a specific interface:
     %prog irc.freenode.net cat '#pycat' --listen=example.com:8000
+  Relay to two channels on freenode and one on efnet from one listener:
+    %prog irc.freenode.net cat '#pycat,#cats' --name=freenode --listen=12345 \
+        --network='efnet irc.efnet.net cat #pycat'
 '''
 
+import bisect
+import cProfile
+import errno
+import fcntl
+import gc
+import heapq
+import json
 import logging
 import os
+import random
 import re
 import select
 import signal
 import socket
+import sre_constants
+import sre_parse
+import stat
+import struct
 import subprocess
+import sys
+import tempfile
+import threading
 import time
 
+from collections import deque, OrderedDict
 from optparse import OptionParser, IndentedHelpFormatter
 
-from ircbot import SingleServerIRCBot, ServerConnectionError, \
-        parse_channel_modes, is_channel, nm_to_n as get_nick
+from ircbot import SingleServerIRCBot, Channel, parse_channel_modes, \
+        is_channel, nm_to_n as get_nick
+
+try:
+    import ctypes
+    import ctypes.util
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 1 # From linux/time.h
+
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    clock_gettime = libc.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+except (ImportError, OSError, AttributeError):
+    libc = None
+    clock_gettime = None
+
+try:
+    inotify_init1 = libc.inotify_init1
+    inotify_init1.argtypes = [ctypes.c_int]
+    inotify_add_watch = libc.inotify_add_watch
+    inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                  ctypes.c_uint32]
+    inotify_rm_watch = libc.inotify_rm_watch
+    inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+except AttributeError:
+    inotify_init1 = None
+    inotify_add_watch = None
+    inotify_rm_watch = None
+
+# From linux/inotify.h
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_Q_OVERFLOW = 0x4000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0x80000
+
+def monotonic():
+    '''Seconds from a clock that does not jump with the wall clock'''
+
+    if clock_gettime is None:
+        return time.time()
+
+    spec = timespec()
+    if clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(spec)) != 0:
+        return time.time()
+    return spec.tv_sec + spec.tv_nsec * 1e-9
+
+def set_cloexec(fd, cloexec=True):
+    '''Set or clear close-on-exec, exec keeps the fds where it is clear'''
+
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+
+    if cloexec:
+        flags |= fcntl.FD_CLOEXEC
+    else:
+        flags &= ~fcntl.FD_CLOEXEC
+
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags)
+
+def keep_on_exec(fds):
+    '''Mark every fd but stdin, stdout, stderr and fds close-on-exec'''
+
+    try:
+        others = map(int, os.listdir('/proc/self/fd'))
+    except OSError:
+        others = range(3, os.sysconf('SC_OPEN_MAX'))
+
+    for fd in others:
+        try:
+            set_cloexec(fd, fd not in fds and fd > 2)
+        except (IOError, OSError):
+            pass # Not open, like the fd listdir used
+
+def handler_name(handler):
+    '''Class and method name of a bound method, for debug output'''
+
+    owner = getattr(handler, 'im_self', None)
+
+    if owner is None:
+        return getattr(handler, '__name__', repr(handler))
+    elif getattr(owner, 'name', None):
+        return '%s(%s).%s' % (owner.__class__.__name__, owner.name,
+            handler.__name__)
+
+    return '%s.%s' % (owner.__class__.__name__, handler.__name__)
+
+# Missing from the socket module in Python 2, value from asm-generic/socket.h
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+def decode(string):
+    '''Force strings into unicode string objects'''
+
+    if isinstance(string, unicode) or string is None:
+        return string
+
+    try:
+        string = string.decode('utf-8')
+    except UnicodeDecodeError:
+        string = string.decode('iso-8859-1')
+    return string
+
+# Every line to and from IRC, the listeners and scripts is decoded or
+# encoded, doing a batch of lines with one codec call saves most of the
+# per call overhead.
+
+def decode_lines(lines):
+    '''
+    decode() for a list of lines without newlines in them, decoding them
+    in one go unless some line needs the latin-1 fallback.
+    '''
+
+    if len(lines) < 2:
+        return map(decode, lines)
+
+    try:
+        return '\n'.join(lines).decode('utf-8').split(u'\n')
+    except UnicodeDecodeError:
+        return map(decode, lines)
+
+def encode(string):
+    '''Encode (unicode) strings as utf-8'''
+
+    if isinstance(string, unicode):
+        return string.encode('utf-8')
+
+    return string
+
+def encode_lines(lines):
+    '''encode() for a list of lines without newlines in them'''
+
+    if len(lines) < 2:
+        return map(encode, lines)
+
+    try:
+        return u'\n'.join(lines).encode('utf-8').split('\n')
+    except UnicodeDecodeError:
+        return map(encode, lines) # Mix of unicode and non-ascii str
+
+# unicode.translate is slow in Python 2, letting a compiled character class
+# find the few control characters and looking them up is much faster.
+UNREADABLE = re.compile(ur'[\x00-\x1F]')
+READABLE_TABLE = dict((unichr(i), u'\\x%02X' % i) for i in range(32))
+
+def readable(string):
+    '''Convert a string to readable format for logging'''
+
+    return UNREADABLE.sub(lambda m: READABLE_TABLE[m.group()], decode(string))
+
+class Readable(object):
+    '''
+    Defers readable() until a log record is actually formatted, so debug
+    logging of every line costs next to nothing when it is turned off.
+    '''
+
+    __slots__ = ('string',)
+
+    def __init__(self, string):
+        self.string = string
+
+    def __unicode__(self):
+        return readable(self.string)
+
+    def __str__(self):
+        return encode(readable(self.string))
+
+class Tracer(object):
+    '''Writes a sample of trace events to a file as JSON, one per line'''
+
+    def __init__(self, path, sample=1.0):
+        self.output = open(path, 'a', 1)
+        self.sample = sample
+
+    def sampled(self):
+        return self.sample >= 1 or random.random() < self.sample
+
+    def event(self, name, **fields):
+        fields['event'] = name
+        fields['time'] = time.time()
+        self.output.write(json.dumps(fields) + '\n')
+
+    def close(self):
+        self.output.close()
+
+class Profiler(object):
+    '''
+    Profiles the event loop for a number of seconds when asked to and counts
+    live objects by type, nothing is recorded while it is idle.
+    '''
+
+    def __init__(self, reactor, directory, seconds=30):
+        self.reactor = reactor
+        self.directory = directory
+        self.seconds = seconds
+        self.profile = None
+        self.timer = None
+        self.counts = None
+
+    def path(self, extension):
+        return os.path.join(self.directory, 'pycat-%d-%s.%s' % (os.getpid(),
+            time.strftime('%Y%m%d-%H%M%S'), extension))
+
+    def start(self, seconds=None):
+        seconds = seconds or self.seconds
+
+        logging.info('Profiling for %gs', seconds)
+        self.timer = self.reactor.call_later(seconds, self.stop)
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop(self):
+        '''Stop profiling and write the stats for python -m pstats'''
+
+        if not self.profile:
+            return
+
+        self.profile.disable()
+        self.reactor.cancel(self.timer)
+
+        path = self.path('prof')
+        try:
+            self.profile.dump_stats(path)
+            logging.info('Profile written to %s', path)
+        except (IOError, OSError), e:
+            logging.error('Could not write profile: %s', e)
+
+        self.profile = None
+        self.timer = None
+
+    def count_objects(self):
+        '''
+        Returns (type name, count, change since the last call) for the
+        objects the garbage collector tracks, biggest change first.
+        '''
+
+        counts = {}
+        for obj in gc.get_objects():
+            cls = getattr(obj, '__class__', type(obj))
+            name = '%s.%s' % (cls.__module__, cls.__name__)
+            counts[name] = counts.get(name, 0) + 1
+
+        previous = self.counts or counts
+        self.counts = counts
+
+        return sorted(((name, count, count - previous.get(name, 0))
+                       for name, count in counts.items()),
+                      key=lambda entry: (-abs(entry[2]), -entry[1]))
+
+class Metrics(object):
+    '''
+    Counters, gauges and histograms rendered in the Prometheus text format.
+    Metrics registered with a function are read from it at render time, the
+    function may return a dict of label tuples to values for labelled series.
+    '''
+
+    BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self, max_series=1000):
+        self.metrics = {}
+        self.order = []
+        self.max_series = max_series
+
+    def register(self, name, kind, help, function=None):
+        if name not in self.metrics:
+            self.order.append(name)
+        self.metrics[name] = (kind, help, {}, function)
+
+    def series(self, name, labels):
+        series = self.metrics[name][2]
+        key = tuple(sorted(labels.items()))
+
+        # Labels such as peer addresses must not grow without bound
+        if key not in series and len(series) >= self.max_series:
+            key = tuple((label, 'other') for label, value in key)
+
+        return series, key
+
+    def inc(self, name, value=1, **labels):
+        series, key = self.series(name, labels)
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        series, key = self.series(name, labels)
+
+        if key not in series:
+            series[key] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+
+        histogram = series[key]
+        histogram[0][bisect.bisect_left(self.BUCKETS, value)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def labels(self, key, *extra):
+        escape = lambda v: encode(v).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n')
+        pairs = ['%s="%s"' % (label, escape(value))
+                 for label, value in key + extra]
+
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join(pairs)
+
+    def render(self):
+        lines = []
+
+        for name in self.order:
+            kind, help, series, function = self.metrics[name]
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+            if function is not None:
+                series = function()
+                if not isinstance(series, dict):
+                    series = {(): series}
+
+            for key, value in sorted(series.items()):
+                if kind != 'histogram':
+                    lines.append('%s%s %s' % (name, self.labels(key), value))
+                    continue
+
+                buckets, total, count = value
+                cumulative = 0
+
+                for bound, observed in zip(self.BUCKETS + ('+Inf',), buckets):
+                    cumulative += observed
+                    lines.append('%s_bucket%s %d' % (name,
+                        self.labels(key, ('le', str(bound))), cumulative))
+
+                lines.append('%s_sum%s %s' % (name, self.labels(key), total))
+                lines.append('%s_count%s %d' % (name, self.labels(key), count))
+
+        return '\n'.join(lines) + '\n'
+
+# Regexes retrived from AnyEvent::IRC::Util on CPAN, they only match ASCII
+# so they work the same on UTF-8 encoded and on unicode strings.
+UNPRINTABLE_SEQUENCES = (r'\x1B\[.*?[\x00-\x1F\x40-\x7E]', # ECMA-48
+                         r'\x03\d\d?(?:,\d\d?)?') # IRC colors
+UNPRINTABLE_CHARS = '\x03\x16\x02\x1f\x0f' # Other unprintables
+
+UNPRINTABLE = re.compile('|'.join(UNPRINTABLE_SEQUENCES +
+    ('[%s]' % UNPRINTABLE_CHARS,)))
+UNPRINTABLE_SEQUENCE = re.compile('|'.join(UNPRINTABLE_SEQUENCES))
+
+def strip_unprintable(string):
+    '''
+    Removes standard unprintable sequences from the text. Byte strings are
+    cheaper, nothing needs to be done for most of them and the single
+    characters go with a translate instead of the regex.
+    '''
+
+    if isinstance(string, unicode):
+        return UNPRINTABLE.sub(u'', string)
+
+    stripped = string.translate(None, UNPRINTABLE_CHARS + '\x1B')
+
+    if len(stripped) == len(string):
+        return string
+    elif '\x1B' in string or '\x03' in string:
+        string = UNPRINTABLE_SEQUENCE.sub('', string)
+
+    return string.translate(None, UNPRINTABLE_CHARS)
+
+def split_utf8(data, length):
+    '''
+    Split UTF-8 encoded data into parts of at most length bytes, at a space
+    when there is one in the second half of a part, else between characters.
+    '''
+
+    parts = []
+    length = max(length, 4) # Room for the longest UTF-8 character
+
+    while len(data) > length:
+        end = data.rfind(' ', 0, length + 1)
+
+        if end > length // 2:
+            parts.append(data[:end])
+            data = data[end + 1:]
+            continue
+
+        end = length
+        while ord(data[end]) & 0xC0 == 0x80:
+            end -= 1 # Don't cut inside a UTF-8 sequence
+
+        parts.append(data[:end])
+        data = data[end:]
+
+    if data or not parts:
+        parts.append(data)
+
+    return parts
+
+def dequote(string):
+    '''
+    Removes matching single or double quotes.
+    '''
+
+    if (string[0] == string[-1]) and string.startswith(("'", '"')):
+        return string[1:-1]
+    return string
+
+class LineFramer(object):
+    '''
+    Splits a byte stream into lines, lines are decoded once they are
+    complete so multi-byte characters split across reads survive. Lines
+    longer than max_length are cut on a UTF-8 character boundary.
+    '''
+
+    def __init__(self, max_length=8192):
+        self.buffer = bytearray()
+        self.max_length = max_length
+        self.scanned = 0
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def feed(self, data):
+        buf = self.buffer
+        buf.extend(data)
+
+        lines = []
+        start = 0
+        search = self.scanned
+
+        while True:
+            end = buf.find('\n', search)
+
+            if end == -1 and len(buf) - start <= self.max_length:
+                break
+            elif end == -1 or end - start > self.max_length:
+                end = start + self.max_length
+                while end > start + 1 and buf[end] & 0xC0 == 0x80:
+                    end -= 1 # Don't cut inside a UTF-8 sequence
+
+                lines.append(str(buf[start:end]))
+                start = search = end
+                continue
+
+            if end > start:
+                lines.append(str(buf[start:end]))
+            start = search = end + 1
+
+        del buf[:start]
+        self.scanned = len(buf)
+
+        return decode_lines(lines)
+
+    def flush(self):
+        '''Return whatever is left once the stream has ended'''
+
+        line = decode(str(self.buffer))
+        del self.buffer[:]
+        self.scanned = 0
+        return line
+
+class Membership(object):
+    '''
+    Nicks in each channel we are in, stored as sets of casemapped names so
+    checking if someone is present is O(1). Kept up to date from join, part,
+    kick, quit, nick and names events.
+    '''
+
+    CASEMAPPINGS = {
+        'ascii': (u'', u''),
+        'rfc1459': (u'[]\\~', u'{}|^'),
+        'strict-rfc1459': (u'[]\\', u'{}|'),
+    }
+
+    def __init__(self):
+        self.channels = {}
+        self.prefixes = u'@+'
+        self.set_casemapping('rfc1459')
+
+    def set_casemapping(self, casemapping):
+        upper, lower = self.CASEMAPPINGS.get(casemapping,
+            self.CASEMAPPINGS['rfc1459'])
+        self.casemapping = casemapping
+
+        table = dict((ord(c), ord(c.lower())) for c in
+            u'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+        table.update((ord(u), ord(l)) for u, l in zip(upper, lower))
+        self.table = table
+
+        # Existing keys might fold differently with the new mapping
+        self.channels = dict((self.lower(channel),
+            set(self.lower(nick) for nick in nicks))
+            for channel, nicks in self.channels.items())
+
+    def lower(self, name):
+        return name.translate(self.table)
+
+    def __contains__(self, channel):
+        return self.lower(channel) in self.channels
+
+    def contains(self, channel, nick):
+        nicks = self.channels.get(self.lower(channel))
+        return nicks is not None and self.lower(nick) in nicks
+
+    def users(self, channel):
+        return len(self.channels.get(self.lower(channel), ()))
+
+    def matches(self, names, name):
+        '''Check if name is one of names'''
+
+        name = self.lower(name)
+
+        for other in names:
+            if self.lower(other) == name:
+                return True
+        return False
+
+    def reaches(self, channels, target):
+        '''Check if target is one of channels we are in or a nick in one'''
+
+        for channel in channels:
+            if channel not in self:
+                continue
+            elif self.lower(target) == self.lower(channel) or \
+                    self.contains(channel, target):
+                return True
+        return False
+
+    def reset(self, channel):
+        self.channels[self.lower(channel)] = set()
+
+    def remove_channel(self, channel):
+        self.channels.pop(self.lower(channel), None)
+
+    def clear(self):
+        self.channels.clear()
+
+    def join(self, channel, nick):
+        channel = self.lower(channel)
+        if channel in self.channels:
+            self.channels[channel].add(self.lower(nick))
+
+    def names(self, channel, names):
+        for nick in names.split():
+            self.join(channel, nick.lstrip(self.prefixes))
+
+    def part(self, channel, nick):
+        channel = self.lower(channel)
+        if channel in self.channels:
+            self.channels[channel].discard(self.lower(nick))
+
+    def quit(self, nick):
+        nick = self.lower(nick)
+        for nicks in self.channels.values():
+            nicks.discard(nick)
+
+    def rename(self, before, after):
+        before, after = self.lower(before), self.lower(after)
+        for nicks in self.channels.values():
+            if before in nicks:
+                nicks.discard(before)
+                nicks.add(after)
+
+class Reactor(object):
+    '''
+    Event loop where file descriptors are registered once with epoll (or
+    select as a fallback) and all timed work lives in one timer heap that
+    decides how long we may sleep.
+    '''
+
+    READ = 1
+    WRITE = 2
+
+    def __init__(self):
+        self.dispatchers = {}
+        self.writers = {}
+        self.filenos = {}
+        self.sockets = {}
+        self.timers = []
+        self.sequence = 0
+
+        self.signal_pipe = None
+        self.signal_handlers = {}
+        self.pending_signals = []
+
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+        else:
+            self.poller = None
+
+    def register(self, sock, handler):
+        if sock in self.dispatchers:
+            self.dispatchers[sock] = handler
+            return
+
+        fileno = sock.fileno()
+        self.dispatchers[sock] = handler
+        self.filenos[sock] = fileno
+        self.sockets[fileno] = sock
+
+        if self.poller:
+            self.poller.register(fileno, select.EPOLLIN | select.EPOLLPRI)
+
+    def unregister(self, sock):
+        if sock not in self.dispatchers:
+            return
+
+        fileno = self.filenos.pop(sock)
+        del self.dispatchers[sock]
+        del self.sockets[fileno]
+        self.writers.pop(sock, None)
+
+        if self.poller:
+            try:
+                self.poller.unregister(fileno)
+            except (IOError, OSError, ValueError):
+                pass # Closing the fd already removed it from epoll
+
+    def register_writer(self, sock, handler):
+        '''Also call handler whenever the registered sock can be written to'''
+
+        self.writers[sock] = handler
+
+        if self.poller:
+            self.poller.modify(self.filenos[sock],
+                select.EPOLLIN | select.EPOLLPRI | select.EPOLLOUT)
+
+    def unregister_writer(self, sock):
+        if sock not in self.writers:
+            return
+
+        del self.writers[sock]
+
+        if self.poller:
+            self.poller.modify(self.filenos[sock],
+                select.EPOLLIN | select.EPOLLPRI)
+
+    def add_signal_handler(self, signum, handler):
+        '''
+        Run handler from the event loop when signum is received, the signal
+        wakes up the loop through a pipe given to signal.set_wakeup_fd.
+        '''
+
+        if self.signal_pipe is None:
+            read_fd, write_fd = os.pipe()
+
+            for fd in (read_fd, write_fd):
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+            self.signal_pipe = os.fdopen(read_fd, 'rb', 0)
+            self.register(self.signal_pipe, self.handle_signal_pipe)
+            signal.set_wakeup_fd(write_fd)
+
+        if signum not in self.signal_handlers:
+            self.signal_handlers[signum] = []
+            signal.signal(signum,
+                lambda signum, frame: self.pending_signals.append(signum))
+            # Don't let the signal interrupt blocking calls elsewhere
+            signal.siginterrupt(signum, False)
+
+        self.signal_handlers[signum].append(handler)
+
+    def handle_signal_pipe(self, pipe):
+        try:
+            os.read(pipe.fileno(), 4096)
+        except OSError:
+            pass
+
+    def run_signals(self):
+        while self.pending_signals:
+            signum = self.pending_signals.pop(0)
+            for handler in self.signal_handlers.get(signum, []):
+                handler()
+
+    def call_later(self, delay, function, *args):
+        '''Run function after delay seconds, returns a cancelable timer'''
+
+        self.sequence += 1
+        timer = [monotonic() + max(delay, 0), self.sequence, function, args]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def cancel(self, timer):
+        if timer:
+            timer[2] = None
+
+    def timeout(self):
+        while self.timers and self.timers[0][2] is None:
+            heapq.heappop(self.timers)
+
+        if not self.timers:
+            return None
+
+        return max(self.timers[0][0] - monotonic(), 0)
+
+    def poll(self, timeout):
+        '''Returns a list of (sock, READ and/or WRITE) that are ready'''
+
+        try:
+            if self.poller:
+                if timeout is None:
+                    timeout = -1
+                return [(self.sockets[fd],
+                         (event & select.EPOLLOUT and self.WRITE) |
+                         (event & ~select.EPOLLOUT and self.READ))
+                        for fd, event in self.poller.poll(timeout)
+                        if fd in self.sockets]
+
+            readable, writable, errors = select.select(
+                self.dispatchers.keys(), self.writers.keys(), [], timeout)
+            return [(sock, self.READ) for sock in readable] + \
+                [(sock, self.WRITE) for sock in writable]
+        except (IOError, OSError, select.error), e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return []
+
+    def run_once(self):
+        for sock, events in self.poll(self.timeout()):
+            # Earlier handlers may have removed this socket
+            if events & self.WRITE and sock in self.writers:
+                self.writers[sock](sock)
+            if events & self.READ and sock in self.dispatchers:
+                self.dispatchers[sock](sock)
+
+        self.run_signals()
+
+        now = monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            when, sequence, function, args = heapq.heappop(self.timers)
+            if function is not None:
+                function(*args)
+
+    def close(self):
+        for sock in self.dispatchers.keys():
+            self.unregister(sock)
+            sock.close()
+
+        if self.poller:
+            self.poller.close()
+
+class TokenBucket(object):
+    '''Allow rate events per second with bursts of up to burst events'''
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.stamp = monotonic()
+
+    def refill(self):
+        now = monotonic()
+        self.tokens = min(self.burst,
+            self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def consume(self):
+        self.refill()
+
+        if self.tokens < 1:
+            return False
+
+        self.tokens -= 1
+        return True
+
+    def delay(self):
+        '''Seconds until the next token is available'''
+
+        self.refill()
+        return max(1 - self.tokens, 0) / self.rate
+
+class SendQueue(object):
+    '''
+    Outbound IRC lines. Protocol commands such as PONG, JOIN and MODE go in
+    a priority lane, everything else is queued per source and per target
+    and sent round-robin so one chatty sender can not starve the others.
+    Lines are popped together with the time they were queued and the ids of
+    the spooled messages they carry.
+    '''
+
+    PRIORITY_COMMANDS = frozenset(['PASS', 'NICK', 'USER', 'PING', 'PONG',
+                                   'JOIN', 'PART', 'MODE', 'QUIT'])
+
+    COALESCE_COMMANDS = frozenset(['PRIVMSG', 'NOTICE'])
+
+    POLICIES = ('block', 'drop-oldest', 'drop-newest', 'summarize')
+
+    def __init__(self, separator=None, max_length=510, max_targets=4,
+                 limit=None, policy='block'):
+        self.priority = deque()
+        self.sources = {}
+        self.rotation = deque()
+        self.length = 0
+
+        # What to do with bulk lines once limit is reached, note that the
+        # block policy relies on the caller to stop reading new lines.
+        self.limit = limit
+        self.policy = policy
+        self.summaries = {}
+        self.dropped = 0
+        self.high_water = 0
+
+        # Spool ids of lines dropped by the policy, for the caller to collect
+        self.discarded = []
+
+        # Coalescing of lines is disabled when separator is None
+        self.separator = separator
+        self.max_length = max_length
+        self.max_targets = max_targets
+
+    def __len__(self):
+        return self.length
+
+    def append(self, string, source=None, ids=()):
+        parts = string.split(' ', 2)
+
+        if parts[0].upper() in self.PRIORITY_COMMANDS:
+            self.length += 1
+            self.priority.append((string, monotonic(), ids))
+            return True
+
+        if len(parts) > 1:
+            target = parts[1]
+        else:
+            target = None
+
+        if self.full() and not self.overflow(string, source, target):
+            self.discarded.extend(ids)
+            return False
+
+        self.length += 1
+        self.high_water = max(self.high_water, self.length)
+        self.queue(source, target).append((string, monotonic(), ids))
+        return True
+
+    def queue(self, source, target):
+        if source not in self.sources:
+            self.sources[source] = ({}, deque())
+            self.rotation.append(source)
+
+        targets, rotation = self.sources[source]
+
+        if target not in targets:
+            targets[target] = deque()
+            rotation.append(target)
+
+        return targets[target]
+
+    def remove(self, source, target):
+        targets, rotation = self.sources[source]
+
+        del targets[target]
+        rotation.remove(target)
+
+        if not rotation:
+            del self.sources[source]
+            self.rotation.remove(source)
+
+    def full(self):
+        return self.limit is not None and self.length >= self.limit
+
+    def overflow(self, string, source, target):
+        '''Apply the overflow policy, returns True if string may be queued'''
+
+        if self.policy == 'block':
+            return True
+
+        self.dropped += 1
+
+        if self.policy == 'drop-newest':
+            return False
+        elif self.policy == 'summarize':
+            key = (source, target)
+            if key not in self.summaries:
+                self.queue(source, target)
+                self.summaries[key] = [string.split(' ', 1)[0], 0,
+                    monotonic()]
+                self.length += 1 # Summary line is sent once queue drains
+            self.summaries[key][1] += 1
+            return False
+
+        # drop-oldest: prefer the sender's own backlog for this target
+        if not self.sources.get(source, ({},))[0].get(target):
+            if not self.rotation:
+                return True
+            source = self.rotation[0]
+            target = self.sources[source][1][0]
+
+        queue = self.sources[source][0][target]
+
+        if queue:
+            self.discarded.extend(queue.popleft()[2])
+            self.length -= 1
+
+            if not queue and (source, target) not in self.summaries:
+                self.remove(source, target)
+
+        return True
+
+    def summary(self, source, target):
+        command, count, queued = self.summaries.pop((source, target))
+        return '%s %s :(%d lines dropped)' % (command, target, count), \
+            queued, ()
+
+    def pop(self):
+        self.length -= 1
+
+        if self.priority:
+            return self.priority.popleft()
+
+        source = self.rotation.popleft()
+        targets, rotation = self.sources[source]
+
+        target = rotation.popleft()
+
+        if targets[target]:
+            entry = targets[target].popleft()
+        else:
+            entry = self.summary(source, target)
+
+        if self.separator is not None:
+            entry = self.coalesce(entry, source, targets, rotation)
+
+        if targets[target] or (source, target) in self.summaries:
+            rotation.append(target)
+        else:
+            del targets[target]
+
+        if rotation:
+            self.rotation.append(source)
+        else:
+            del self.sources[source]
+
+        return entry
+
+    def split(self, string):
+        '''Split a line into command, target and text if it can be merged'''
+
+        parts = string.split(' ', 2)
+
+        if len(parts) != 3 or parts[0] not in self.COALESCE_COMMANDS:
+            return None
+        elif not parts[2].startswith(':') or parts[2].startswith(':\x01'):
+            return None # Not a plain message or a CTCP
+
+        return parts[0], parts[1], parts[2][1:]
+
+    def coalesce(self, entry, source, targets, rotation):
+        '''
+        Merge queued messages for the same target into one line, and the
+        same text for other targets from this source into one multi-target
+        line, as long as the result stays within max_length.
+        '''
+
+        string, queued, ids = entry
+        parts = self.split(string)
+
+        if not parts:
+            return entry
+
+        command, target, text = parts
+        queue = targets[target]
+
+        while queue:
+            parts = self.split(queue[0][0])
+
+            if not parts or parts[0] != command:
+                break
+
+            merged = text + self.separator + parts[2]
+            if len(command) + len(target) + len(merged) + 3 > self.max_length:
+                break
+
+            text = merged
+            ids += queue.popleft()[2]
+            self.length -= 1
+
+        merged = [target]
+        count = target.count(',') + 1
+
+        for other in list(rotation):
+            if not targets[other]:
+                continue
+            elif self.split(targets[other][0][0]) != (command, other, text):
+                continue
+            elif count + other.count(',') + 1 > self.max_targets:
+                continue
+
+            line_length = len(command) + len(text) + 3 + \
+                len(','.join(merged + [other]))
+            if line_length > self.max_length:
+                break
+
+            merged.append(other)
+            count += other.count(',') + 1
+
+            ids += targets[other].popleft()[2]
+            self.length -= 1
+
+            if not targets[other] and (source, other) not in self.summaries:
+                del targets[other]
+                rotation.remove(other)
+
+        return '%s %s :%s' % (command, ','.join(merged), text), queued, ids
+
+    def dump(self):
+        '''
+        Queued lines as (string, queued, ids, source) in about the order
+        they would be sent, and pending summaries, for load() to restore.
+        '''
+
+        entries = [(string, queued, ids, None)
+                   for string, queued, ids in self.priority]
+
+        for source in self.rotation:
+            targets, rotation = self.sources[source]
+            for target in rotation:
+                entries.extend((string, queued, ids, source)
+                               for string, queued, ids in targets[target])
+
+        summaries = [(source, target) + tuple(summary)
+                     for (source, target), summary in self.summaries.items()]
+
+        return entries, summaries
+
+    def load(self, entries, summaries):
+        for string, queued, ids, source in entries:
+            string = encode(string)
+            parts = string.split(' ', 2)
+
+            if parts[0].upper() in self.PRIORITY_COMMANDS:
+                queue = self.priority
+            else:
+                queue = self.queue(source, len(parts) > 1 and parts[1] or None)
+
+            queue.append((string, queued, tuple(ids)))
+            self.length += 1
+
+        for source, target, command, count, queued in summaries:
+            self.queue(source, target)
+            self.summaries[(source, target)] = [command, count, queued]
+            self.length += 1
+
+        self.high_water = max(self.high_water, self.length)
+
+    def clear(self):
+        self.priority.clear()
+        self.sources.clear()
+        self.summaries.clear()
+        self.rotation.clear()
+        self.length = 0
+
+class Deduplicator(object):
+    '''
+    Collapses repeats of a message to the same targets within window
+    seconds, the first copy goes through and the rest are counted and given
+    to callback as a single summary once the window is over. Messages are
+    compared after replacing whatever the mask regexps match, so lines that
+    only differ in counters or timestamps are taken as repeats.
+    '''
+
+    def __init__(self, reactor, window, callback, masks=None, max_keys=10000):
+        self.reactor = reactor
+        self.window = window
+        self.callback = callback
+        self.masks = [re.compile(mask, re.UNICODE) for mask in masks or []]
+        self.max_keys = max_keys
+
+        # Key to [expires, network, message, targets, source, repeats], in
+        # the order they expire
+        self.entries = OrderedDict()
+        self.timer = None
+
+        self.suppressed = 0
+        self.summaries = 0
+
+    def normalize(self, message):
+        for mask in self.masks:
+            message = mask.sub(u'\0', message)
+
+        return u' '.join(message.split())
+
+    def admit(self, network, message, targets, source):
+        '''Returns True if message should be sent, False for a repeat'''
+
+        key = (network.name, tuple(sorted(targets)), self.normalize(message))
+        entry = self.entries.get(key)
+
+        if entry:
+            entry[2] = message # Summarize the latest copy
+            entry[5] += 1
+            self.suppressed += 1
+            return False
+
+        if len(self.entries) >= self.max_keys:
+            self.expire(next(iter(self.entries)))
+
+        self.entries[key] = [monotonic() + self.window, network, message,
+            targets, source, 0]
+
+        if self.timer is None:
+            self.timer = self.reactor.call_later(self.window,
+                self.handle_timer)
+
+        return True
+
+    def handle_timer(self):
+        self.timer = None
+        now = monotonic()
+
+        for key, entry in self.entries.items():
+            if entry[0] > now:
+                self.timer = self.reactor.call_later(entry[0] - now,
+                    self.handle_timer)
+                break
+            self.expire(key)
+
+    def expire(self, key):
+        expires, network, message, targets, source, repeats = \
+            self.entries.pop(key)
+
+        if repeats:
+            self.summaries += 1
+            self.callback(network, u'%s (repeated %dx in %gs)' % (message,
+                repeats, self.window), targets, source)
+
+    def close(self):
+        self.reactor.cancel(self.timer)
+        self.entries.clear()
+
+class Spool(object):
+    '''
+    Append-only log of accepted messages in numbered segment files, so they
+    survive disconnects and restarts until they have been sent. Messages
+    and acknowledgements are written as JSON lines and fsynced in batches,
+    segments go away once every message in them and in the segments before
+    them is acknowledged or expired.
+    Only ids are kept in memory, each network replays from its own cursor.
+    '''
+
+    SEGMENT_SIZE = 1024 * 1024
+
+    def __init__(self, reactor, path, ttl=3600, sync=1.0,
+                 segment_size=SEGMENT_SIZE):
+        self.reactor = reactor
+        self.path = path
+        self.ttl = ttl
+        self.sync = sync
+        self.segment_size = segment_size
+
+        self.segments = OrderedDict() # Segment number to unsent messages
+        self.newest = {}              # Segment number to newest message time
+        self.pending = {}             # Unsent message id to (segment, network)
+        self.cursors = {}             # Network name to (segment, offset)
+        self.last_id = 0
+        self.expired = 0
+
+        self.active = None
+        self.file = None
+        self.size = 0
+        self.sync_timer = None
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.load()
+        self.rotate()
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, '%08d.spool' % segment)
+
+    def load(self):
+        '''Find unsent messages left behind by an earlier run'''
+
+        now = time.time()
+
+        for name in sorted(os.listdir(self.path)):
+            match = re.match(r'^(\d+)\.spool$', name)
+
+            if not match:
+                continue
+
+            segment = int(match.group(1))
+            self.segments[segment] = 0
+
+            for offset, record in self.read(segment):
+                if 'ack' in record:
+                    acked = self.pending.pop(record['ack'], None)
+                    if acked is not None:
+                        self.segments[acked[0]] -= 1
+                    continue
+
+                self.last_id = max(self.last_id, record['id'])
+                self.newest[segment] = record['time']
+
+                if self.expires(record, now):
+                    self.expired += 1
+                else:
+                    self.pending[record['id']] = (segment, record['network'])
+                    self.segments[segment] += 1
+
+        self.compact()
+
+        if self.pending:
+            logging.info('Spool has %d unsent messages', len(self.pending))
+
+    def read(self, segment, offset=0):
+        '''Yield (offset after record, record) for segment from offset'''
+
+        try:
+            spool = open(self.segment_path(segment), 'rb')
+        except IOError:
+            return # Removed since we last looked
+
+        try:
+            spool.seek(offset)
+
+            for line in iter(spool.readline, ''):
+                if not line.endswith('\n'):
+                    break # Cut short by a crash
+
+                offset += len(line)
+
+                try:
+                    yield offset, json.loads(line)
+                except ValueError:
+                    logging.warning('Skipping invalid spool record in %s',
+                        self.segment_path(segment))
+        finally:
+            spool.close()
+
+    def expires(self, record, now):
+        return self.ttl and record['time'] + self.ttl < now
+
+    def write(self, record):
+        line = json.dumps(record) + '\n'
+
+        try:
+            self.file.write(line)
+        except IOError, e:
+            logging.error('Could not write to spool: %s', e)
+            return
+
+        self.size += len(line)
+
+        if not self.sync:
+            self.flush(True)
+        elif not self.sync_timer:
+            self.sync_timer = self.reactor.call_later(self.sync,
+                self.handle_sync)
+
+    def handle_sync(self):
+        self.sync_timer = None
+        self.flush(True)
+
+    def flush(self, sync=False):
+        try:
+            self.file.flush()
+            if sync:
+                os.fsync(self.file.fileno())
+        except (IOError, OSError), e:
+            logging.error('Could not sync spool: %s', e)
+
+    def rotate(self):
+        '''Start a new segment, removing the old one if it is all sent'''
+
+        previous, size = self.active, self.size
+
+        if self.file:
+            self.flush(True)
+            self.file.close()
+
+        self.active = max(self.segments.keys() + [0]) + 1
+        self.segments[self.active] = 0
+        self.file = open(self.segment_path(self.active), 'ab')
+        self.size = 0
+
+        for network, cursor in self.cursors.items():
+            if cursor == (previous, size):
+                self.cursors[network] = (self.active, 0)
+
+        self.compact()
+
+    def compact(self):
+        '''
+        Remove sent segments from the oldest on, counting the unsent
+        messages of segments where even the newest has expired as sent.
+        Acks are written to the active segment, so a segment may hold the
+        acks for messages in older ones and has to stay until they are gone
+        too.
+        '''
+
+        now = time.time()
+
+        for segment, count in self.segments.items():
+            if segment == self.active:
+                break
+            elif count and self.ttl and \
+                    self.newest.get(segment, 0) + self.ttl < now:
+                self.expire(segment)
+            elif count:
+                break
+
+            self.remove(segment)
+
+    def expire(self, segment):
+        '''
+        Forget the unsent messages in segment, replay skips them and an
+        earlier run would not have loaded them anyway.
+        '''
+
+        for spool_id, (pending, network) in self.pending.items():
+            if pending == segment:
+                del self.pending[spool_id]
+                self.expired += 1
+
+        self.segments[segment] = 0
+
+    def remove(self, segment):
+        logging.debug('Removing spool segment %s', self.segment_path(segment))
+
+        del self.segments[segment]
+        self.newest.pop(segment, None)
+
+        try:
+            os.unlink(self.segment_path(segment))
+        except OSError, e:
+            logging.error('Could not remove spool segment: %s', e)
+
+    def append(self, network, targets, message, source=None):
+        '''
+        Store message for targets on network. Returns its id and whether the
+        network is caught up and should send it right away, otherwise it
+        will come out of replay.
+        '''
+
+        if self.size >= self.segment_size:
+            self.rotate()
+
+        end = (self.active, self.size)
+        current = self.cursors.get(network) == end
+
+        self.last_id += 1
+        self.newest[self.active] = time.time()
+        self.write({'id': self.last_id, 'time': self.newest[self.active],
+            'network': network, 'targets': targets, 'message': message,
+            'source': source})
+
+        self.pending[self.last_id] = (self.active, network)
+        self.segments[self.active] += 1
+        self.advance(end)
+
+        return self.last_id, current
+
+    def ack(self, spool_id):
+        '''Mark a message as sent, removing segments that are all sent'''
+
+        acked = self.pending.pop(spool_id, None)
+
+        if acked is None:
+            return
+
+        segment, network = acked
+        end = (self.active, self.size)
+
+        self.write({'ack': spool_id})
+        self.segments[segment] -= 1
+        self.advance(end, network)
+
+        if not self.segments[segment]:
+            self.compact()
+
+    def advance(self, end, skip=None):
+        '''
+        Move cursors that were at end past what was just written, records
+        for one network don't hold up the others. The cursor of skip is
+        left to look at the spool again.
+        '''
+
+        for network, cursor in self.cursors.items():
+            if cursor == end and network != skip:
+                self.cursors[network] = (self.active, self.size)
+
+    def start(self, network):
+        '''Replay unsent messages for network from the oldest segment'''
+
+        self.cursors[network] = (self.segments.keys()[0], 0)
+
+    def stop(self, network):
+        self.cursors.pop(network, None)
+
+    def replay(self, network, count):
+        '''Up to count unsent messages for network from its cursor'''
+
+        cursor = self.cursors.get(network)
+
+        if count <= 0 or cursor in (None, (self.active, self.size)):
+            return []
+
+        self.flush()
+
+        segment, offset = cursor
+        records = []
+        now = time.time()
+
+        while len(records) < count:
+            for offset, record in self.read(segment, offset):
+                if record.get('network') != network or \
+                        record.get('id') not in self.pending:
+                    continue
+                elif self.expires(record, now):
+                    self.expired += 1
+                    self.ack(record['id'])
+                    continue
+
+                records.append(record)
+
+                if len(records) >= count:
+                    break
+            else:
+                later = [s for s in self.segments if s > segment]
+
+                if not later:
+                    break
+
+                segment, offset = later[0], 0
+                continue
+            break
+
+        self.cursors[network] = (segment, offset)
+        return records
+
+    def close(self):
+        self.reactor.cancel(self.sync_timer)
+        self.flush(True)
+        self.file.close()
+
+class Router(object):
+    '''
+    Decides which script a message should go to. All rules are compiled into
+    one regexp with a named group per rule so a single search picks the
+    route no matter how many rules there are. Rules anchored with ^ are
+    combined under a shared ^ so the search gives up after the first
+    position instead of trying every rule at every offset.
+
+    When matches start at the same position the first rule wins, routes
+    from the command line come before the ones from --config and the match
+    setting comes last. Rules with numbered back references can't be
+    combined and are searched on their own, the same way.
+    '''
+
+    # Python's re module only supports 100 groups in a single expression
+    MAX_GROUPS = 99
+
+    def __init__(self, routes=None):
+        self.routes = routes or []
+        self.config_routes = []
+        self.default = None
+
+        self.nick = None
+        self.regexps = []
+        self.rules = []
+        self.scripts = {}
+        self.separate = []
+
+        # Each network may have us under a different nick
+        self.compiled = {}
+
+    def set_default(self, match, script):
+        self.default = (match, script)
+        self.nick = None
+        self.compiled.clear()
+
+    def set_config_routes(self, routes):
+        self.config_routes = routes
+        self.nick = None
+        self.compiled.clear()
+
+    def anchored(self, match):
+        '''Check if match starts with a ^ that applies to all of it'''
+
+        if not match.startswith('^'):
+            return False
+
+        parsed = sre_parse.parse(match, re.UNICODE)
+        return len(parsed) > 0 and \
+            parsed[0] == (sre_constants.AT, sre_constants.AT_BEGINNING)
+
+    def compile(self, nick):
+        rules = list(self.routes) + list(self.config_routes)
+        if self.default:
+            rules.append(self.default)
+
+        self.nick = nick
+        self.regexps = []
+        self.rules = []
+        self.scripts = {}
+        self.separate = []
+
+        # Filled in below, the cache shares these objects
+        self.compiled[nick] = (self.regexps, self.rules, self.scripts,
+            self.separate)
+
+        chunks = {True: [[]], False: [[]]}
+        groups = {True: 0, False: 0}
+
+        for match, script in rules:
+            # Can be replaced with string.Template.safe_substitute, but
+            # requires 2.4
+            match = re.sub(r'(?<!\$)\$nick', nick, match or '')
+            match = re.sub(r'\$\$nick', '$nick', match)
+
+            try:
+                regexp = re.compile(match, re.UNICODE)
+            except re.error, e:
+                logging.error("Problem with match expression '%s': %s",
+                    match, e)
+                continue
+
+            index = len(self.rules)
+            self.rules.append((regexp, script))
+
+            # Numbered back references would point at the wrong group
+            if re.search(r'\\[1-9]', match):
+                self.separate.append((index, regexp, script))
+                continue
+
+            anchored = self.anchored(match)
+            if anchored:
+                match = match[1:]
+
+            if groups[anchored] + regexp.groups + 1 > self.MAX_GROUPS:
+                chunks[anchored].append([])
+                groups[anchored] = 0
+
+            name = 'route%d' % index
+            chunks[anchored][-1].append(u'(?P<%s>%s)' % (name, match))
+            groups[anchored] += regexp.groups + 1
+            self.scripts[name] = (index, script)
+
+        try:
+            for chunk in chunks[True]:
+                if chunk:
+                    self.regexps.append(re.compile(
+                        u'^(?:%s)' % u'|'.join(chunk), re.UNICODE))
+            for chunk in chunks[False]:
+                if chunk:
+                    self.regexps.append(re.compile(
+                        u'|'.join(chunk), re.UNICODE))
+        except re.error, e:
+            logging.error('Could not combine match expressions: %s', e)
+            del self.regexps[:]
+            self.separate[:] = [(index, regexp, script) for index,
+                (regexp, script) in enumerate(self.rules)]
+
+    def route(self, message, nick):
+        '''Returns the script message should be sent to, if any'''
+
+        if nick != self.nick and nick in self.compiled:
+            self.nick = nick
+            self.regexps, self.rules, self.scripts, self.separate = \
+                self.compiled[nick]
+        elif nick != self.nick:
+            self.compile(nick)
+
+        best = None
+
+        for regexp in self.regexps:
+            match = regexp.search(message)
+            if not match:
+                continue
+
+            found = (match.start(), self.scripts[match.lastgroup])
+            if best is None or found < best:
+                best = found
+
+        for index, regexp, script in self.separate:
+            match = regexp.search(message)
+            if not match:
+                continue
+
+            found = (match.start(), (index, script))
+            if best is None or found < best:
+                best = found
+
+        return best and best[1][1]
+
+class Child(object):
+    def __init__(self, process, name, limited, exited=None):
+        self.process = process
+        self.name = name
+        self.limited = limited
+        self.exited = exited
+        self.started = monotonic()
+        self.timer = None
+
+class Orphan(object):
+    '''
+    Stands in for the Popen object of a script started before a restart,
+    the process is still our child but subprocess no longer knows about it.
+    '''
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is not None:
+            return self.returncode
+
+        try:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+        except OSError:
+            pid, status = self.pid, 0 # Reaped elsewhere
+
+        if not pid:
+            return None
+        elif os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+
+        return self.returncode
+
+class Supervisor(object):
+    '''
+    Starts script processes, keeping at most limit of them running with the
+    rest waiting in a bounded FIFO queue. Children are reaped on SIGCHLD and
+    processes that overstay their timeout get SIGTERM followed by SIGKILL.
+    '''
+
+    def __init__(self, reactor, limit=10, queue_size=50, timeout=30,
+                 grace=5, metrics=None):
+        self.reactor = reactor
+        self.metrics = metrics
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.grace = grace
+
+        self.children = {}
+        self.waiting = deque()
+        self.running = 0
+
+        self.spawned = 0
+        self.timeouts = 0
+        self.history = deque(maxlen=100)
+
+        reactor.add_signal_handler(signal.SIGCHLD, self.reap)
+
+    def spawn(self, args, callback, limited=True, timeout=True, **kwargs):
+        '''
+        Start args and pass the process to callback, possibly after waiting
+        for a free slot. An exited callback in kwargs gets the process once
+        it has been reaped. Returns False if the process can not be started.
+        '''
+
+        if limited and self.running >= self.limit:
+            if len(self.waiting) >= self.queue_size:
+                logging.warning('Too many scripts waiting, dropping: %s',
+                    ' '.join(args))
+                return False
+
+            self.waiting.append((args, callback, timeout, kwargs))
+            return True
+
+        # Own process group so grandchildren can be killed along with it
+        options = {'stdout': subprocess.PIPE, 'stderr': subprocess.PIPE,
+                   'preexec_fn': os.setpgrp, 'close_fds': True}
+        options.update(kwargs)
+        name = options.pop('name', args[0])
+        exited = options.pop('exited', None)
+
+        try:
+            process = subprocess.Popen(args, **options)
+        except OSError, e:
+            logging.error('Could not start process: %s', e)
+            return False
+
+        child = Child(process, name, limited, exited)
+        self.children[process.pid] = child
+        self.spawned += 1
+
+        if limited:
+            self.running += 1
+
+        if timeout:
+            child.timer = self.reactor.call_later(self.timeout,
+                self.handle_timeout, child)
+
+        callback(process)
+        return True
+
+    def handle_timeout(self, child):
+        if child.process.poll() is None:
+            logging.error('%s pid:%s taking to long, sending SIGTERM',
+                child.name, child.process.pid)
+            self.timeouts += 1
+            self.terminate(child.process)
+
+    def terminate(self, process):
+        '''Send SIGTERM and follow up with SIGKILL after the grace period'''
+
+        child = self.children.get(process.pid)
+
+        if child is None:
+            return
+
+        self.kill(child, signal.SIGTERM)
+        self.reactor.cancel(child.timer)
+        child.timer = self.reactor.call_later(self.grace, self.kill,
+            child, signal.SIGKILL)
+
+    def kill(self, child, signum):
+        if signum == signal.SIGKILL:
+            logging.error('%s pid:%s ignored SIGTERM, sending SIGKILL',
+                child.name, child.process.pid)
+
+        try:
+            os.killpg(child.process.pid, signum)
+        except OSError:
+            pass # Already gone
+
+    def reap(self):
+        for pid, child in self.children.items():
+            if child.process.poll() is None:
+                continue
+
+            runtime = monotonic() - child.started
+            status = child.process.returncode
+
+            logging.debug('%s pid:%s exited with %s after %.3fs',
+                child.name, pid, status, runtime)
+
+            self.history.append((child.name, pid, status, runtime))
+
+            if self.metrics:
+                self.metrics.observe('pycat_script_duration_seconds',
+                    runtime, script=child.name)
+            self.reactor.cancel(child.timer)
+            del self.children[pid]
+
+            if child.limited:
+                self.running -= 1
+
+            if child.exited:
+                child.exited(child.process)
+
+        while self.waiting and self.running < self.limit:
+            args, callback, timeout, kwargs = self.waiting.popleft()
+            self.spawn(args, callback, True, timeout, **kwargs)
+
+    def stop(self, keep=()):
+        '''Terminate all children except those with pids in keep'''
+
+        self.waiting.clear()
+
+        for pid, child in self.children.items():
+            if pid not in keep:
+                self.terminate(child.process)
+
+    def adopt(self, orphans, kill=True):
+        '''
+        Look after (pid, name) of children of the process we replaced,
+        killing scripts it terminated if they are still around after the
+        grace period. Returns the stand-ins for their Popen objects.
+        '''
+
+        processes = []
+
+        for pid, name in orphans:
+            child = Child(Orphan(pid), name, False)
+            if kill:
+                child.timer = self.reactor.call_later(self.grace, self.kill,
+                    child, signal.SIGKILL)
+            self.children[pid] = child
+            processes.append(child.process)
+
+        self.reap() # Their SIGCHLD may have come before our handler
+        return processes
+
+class RateLimiter(object):
+    '''Token buckets per key, parsed from a count/seconds specification'''
+
+    def __init__(self, spec, max_keys=1000):
+        count, seconds = spec.split('/', 1)
+
+        self.count = int(count)
+        self.rate = self.count / float(seconds)
+        self.max_keys = max_keys
+        self.buckets = {}
+
+    def allow(self, key):
+        if key not in self.buckets:
+            if len(self.buckets) >= self.max_keys:
+                self.prune()
+            self.buckets[key] = TokenBucket(self.rate, self.count)
+
+        return self.buckets[key].consume()
+
+    def prune(self):
+        '''Forget keys that have been quiet long enough to be full again'''
+
+        for key, bucket in self.buckets.items():
+            bucket.refill()
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[key]
+
+class ResponseCache(object):
+    '''
+    Script replies kept for ttl seconds, dropping the least recently used
+    once they add up to more than max_bytes. Commands that are already
+    running are tracked in pending so identical ones can wait for the same
+    reply instead of starting the script again.
+    '''
+
+    def __init__(self, max_bytes=1024*1024):
+        self.max_bytes = max_bytes
+        self.ttl = 0
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+
+        expires, lines, size = self.entries.pop(key)
+
+        if expires < monotonic():
+            self.size -= size
+            self.misses += 1
+            return None
+
+        self.entries[key] = (expires, lines, size)
+        self.hits += 1
+        return lines
+
+    def put(self, key, lines):
+        size = sum(len(line) for line in lines)
+
+        if not self.ttl or size > self.max_bytes:
+            return
+
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[2]
+
+        self.entries[key] = (monotonic() + self.ttl, lines, size)
+        self.size += size
+
+        while self.size > self.max_bytes:
+            expires, old, old_size = self.entries.popitem(last=False)[1]
+            self.size -= old_size
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+class FileWatcher(object):
+    '''
+    Calls callback when a file has changed. Uses inotify on the directory so
+    files replaced by a rename are noticed too, and only reacts once the
+    writer has closed the file. When the path goes through a symlink the
+    directory of the file it points to is watched as well. Where inotify is
+    missing the file is polled with stat and has to be left alone for settle
+    seconds before it counts as changed. Either way changes are debounced so
+    a burst of them only gives one call.
+    '''
+
+    EVENTS = IN_CLOSE_WRITE | IN_MOVED_TO | IN_ATTRIB
+
+    def __init__(self, reactor, path, callback, debounce=0.1, settle=2,
+                 interval=5):
+        self.reactor = reactor
+        self.path = os.path.abspath(path)
+        self.callback = callback
+        self.debounce = debounce
+        self.settle = settle
+        self.interval = interval
+
+        self.signature = self.stat()
+        self.timer = None
+        self.poll_timer = None
+        self.inotify = None
+        self.watches = {}
+
+        if not self.setup_inotify():
+            self.poll_timer = self.reactor.call_later(self.interval,
+                self.handle_poll)
+
+    def setup_inotify(self):
+        if inotify_init1 is None:
+            return False
+
+        fd = inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            logging.warning('inotify not available, polling %s: %s',
+                self.path, os.strerror(ctypes.get_errno()))
+            return False
+
+        self.inotify = os.fdopen(fd, 'rb', 0)
+
+        if not self.watch():
+            self.inotify.close()
+            self.inotify = None
+            return False
+
+        self.reactor.register(self.inotify, self.handle_inotify)
+        return True
+
+    def watch(self):
+        '''
+        Watch the directory of the path and of what it resolves to, which
+        differ for symlinks, dropping watches for what a symlink used to
+        point to. Returns False if one could not be watched.
+        '''
+
+        paths = set([self.path, os.path.realpath(self.path)])
+        watches = {}
+
+        for path in paths:
+            directory, name = os.path.split(encode(path))
+            wd = inotify_add_watch(self.inotify.fileno(), directory,
+                self.EVENTS)
+
+            if wd < 0:
+                logging.warning('Could not watch %s, polling %s instead: %s',
+                    directory, self.path, os.strerror(ctypes.get_errno()))
+                return False
+
+            watches.setdefault(wd, set()).add(name)
+
+        for wd in self.watches:
+            if wd not in watches:
+                inotify_rm_watch(self.inotify.fileno(), wd)
+
+        self.watches = watches
+        return True
+
+    def stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def handle_inotify(self, inotify):
+        try:
+            data = os.read(inotify.fileno(), 4096)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                logging.error('Could not read inotify events: %s', e)
+            return
+
+        offset = 0
+
+        while offset + 16 <= len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            event = data[offset + 16:offset + 16 + length].rstrip('\0')
+            offset += 16 + length
+
+            if event in self.watches.get(wd, ()) or mask & IN_Q_OVERFLOW:
+                self.changed()
+
+    def handle_poll(self):
+        self.poll_timer = self.reactor.call_later(self.interval,
+            self.handle_poll)
+
+        if self.stat() != self.signature:
+            self.changed()
+
+    def changed(self):
+        self.reactor.cancel(self.timer)
+        self.timer = self.reactor.call_later(self.debounce, self.handle_timer)
+
+    def handle_timer(self):
+        self.timer = None
+        signature = self.stat()
+
+        if signature is None or signature == self.signature:
+            return # Gone for now or only touched, wait for the next event
+
+        # Polling can't tell if the file is still being written to
+        age = time.time() - signature[0]
+        if self.inotify is None and age < self.settle:
+            self.timer = self.reactor.call_later(self.settle - age,
+                self.handle_timer)
+            return
+
+        self.signature = signature
+
+        # A symlink may have been pointed somewhere else
+        if self.inotify and not self.poll_timer and not self.watch():
+            self.poll_timer = self.reactor.call_later(self.interval,
+                self.handle_poll)
+
+        self.callback()
+
+    def close(self):
+        self.reactor.cancel(self.timer)
+        self.reactor.cancel(self.poll_timer)
+
+        if self.inotify:
+            self.reactor.unregister(self.inotify)
+            self.inotify.close()
+
+class Worker(object):
+    '''Long-lived script process answering one framed request at a time'''
+
+    def __init__(self, process):
+        self.process = process
+        self.request = None
+        self.timer = None
+
+class Client(object):
+    '''Stream connection to one of the listeners'''
+
+    def __init__(self, peer):
+        self.peer = peer
+        self.last = monotonic()
+        self.partial = None
+        self.received = 0
+        self.timer = None
+
+class HTTPClient(object):
+    '''Keep-alive connection to the HTTP ingest listener'''
+
+    def __init__(self, peer):
+        self.peer = peer
+        self.data = ''
+        self.output = ''
+        self.closing = False
+        self.timer = None
+
+class IngestWorker(object):
+    '''Ingest worker process and the socket it sends messages over'''
+
+    def __init__(self, process, sock, max_length):
+        self.process = process
+        self.sock = sock
+        self.framer = LineFramer(max_length)
+        self.output = ''
+
+class IngestNetwork(object):
+    '''
+    Stands in for a network inside an ingest worker, checking targets the
+    same way against snapshots of the membership sent by the relay.
+    '''
+
+    def __init__(self, network):
+        self.name = network.name
+        self.channel = network.channel
+        self.channel_names = network.channel_names
+        self.membership = Membership()
+        self.limited = False
+
+    def update(self, snapshot):
+        self.membership.set_casemapping(snapshot['casemapping'])
+        self.membership.prefixes = snapshot['prefixes']
+        self.membership.channels = dict((channel, set(nicks)) for channel,
+            nicks in snapshot['channels'].items())
+        self.limited = snapshot['limited']
+
+    def allowed(self, target):
+        if self.limited:
+            return self.membership.matches(self.channel_names, target)
+
+        return self.membership.reaches(self.channel_names, target)
+
+class Resolver(object):
+    '''
+    Looks up host names in helper threads so a slow or unreachable resolver
+    can't hold up the event loop. Results are passed back through a pipe and
+    callbacks get the addresses, or the socket.error, from the loop.
+    '''
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.results = deque()
+        self.pipe = None
+        self.wakeup = None
+
+    def resolve(self, host, port, callback, *args):
+        '''Call callback(addresses or error, *args) once host is looked up'''
+
+        if self.pipe is None:
+            read_fd, write_fd = os.pipe()
+
+            for fd in (read_fd, write_fd):
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+                set_cloexec(fd)
+
+            self.pipe = os.fdopen(read_fd, 'rb', 0)
+            self.wakeup = write_fd
+            self.reactor.register(self.pipe, self.handle_pipe)
+
+        thread = threading.Thread(target=self.lookup,
+            args=(host, port, callback, args))
+        thread.daemon = True # Don't wait for a hung lookup when exiting
+        thread.start()
+
+    def lookup(self, host, port, callback, args):
+        '''Runs in the helper thread'''
+
+        try:
+            result = socket.getaddrinfo(host, port, socket.AF_UNSPEC,
+                socket.SOCK_STREAM)
+        except socket.error, e:
+            result = e
+
+        self.results.append((callback, result, args))
+
+        try:
+            os.write(self.wakeup, '\0')
+        except OSError:
+            pass # Pipe full, the loop is already being woken up
+
+    def handle_pipe(self, pipe):
+        try:
+            os.read(pipe.fileno(), 4096)
+        except OSError:
+            pass
+
+        while self.results:
+            callback, result, args = self.results.popleft()
+            callback(result, *args)
+
+    def close(self):
+        if self.pipe:
+            self.reactor.unregister(self.pipe)
+            self.pipe.close()
+            os.close(self.wakeup)
+            self.pipe = None
+
+class Server(object):
+    '''
+    Entry from the server list with a health score, the decaying share of
+    attempts that got us registered, and how long registering usually takes.
+    '''
+
+    DECAY = 0.7
+
+    def __init__(self, host, port, password=None):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.health = 1.0
+        self.latency = None
+
+    def __str__(self):
+        return '%s:%s' % (self.host, self.port)
+
+    def preference(self):
+        '''Sort key putting healthy and then fast servers first'''
+
+        return -self.health, self.latency is None, self.latency
+
+    def succeeded(self, latency):
+        self.health = self.health * self.DECAY + (1 - self.DECAY)
+
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = self.latency * self.DECAY + \
+                latency * (1 - self.DECAY)
+
+    def failed(self):
+        self.health *= self.DECAY
+
+class Relay(object):
+    '''
+    Owns the event loop and everything the IRC networks share: the listener,
+    the stats endpoint, metrics and the script dispatcher. Lines addressed to
+    #channel@network go out through that network's connection, everything
+    else goes to the first network.
+    '''
+
+    HTTP_STATUS = {200: 'OK', 202: 'Accepted', 400: 'Bad Request',
+                   405: 'Method Not Allowed', 411: 'Length Required',
+                   413: 'Request Entity Too Large', 429: 'Too Many Requests',
+                   431: 'Request Header Fields Too Large',
+                   503: 'Service Unavailable'}
+
+    HTTP_MAX_HEADER = 8192
+    HTTP_MAX_BODY = 1024 * 1024
+    HTTP_IDLE = 60
+
+    MESSAGE_TYPES = {'privmsg': '', 'notice': '/notice ', 'action': '/me '}
+
+    # Datagrams to read per wakeup before giving other sockets a turn
+    DATAGRAM_BATCH = 64
+
+    # Tells a restarted pycat which fd holds the state handed over to it
+    RESTART_ENV = 'PYCAT_RESTART'
+
+    # Tells an ingest worker its socket to the relay and inherited listeners,
+    # membership snapshots are sent to the workers every SNAPSHOT_INTERVAL
+    # seconds when they have changed
+    INGEST_ENV = 'PYCAT_INGEST'
+    INGEST_MAX_LINE = 16 * 1024 * 1024
+    SNAPSHOT_INTERVAL = 1
+
+    def __init__(self, listen_addrs=None, script=None, queue_high=500,
+                 queue_low=250, workers=0, script_timeout=30, max_scripts=10,
+                 script_queue=50, nick_rate=None, channel_rate=None,
+                 recv_size=4096, max_line=8192, routes=None, trace=None,
+                 stats_addr=None, http_addr=None, backlog=128,
+                 max_clients=1000, max_clients_per_ip=0, client_idle=0,
+                 client_deadline=0, client_max_bytes=0, spool=None,
+                 spool_ttl=3600, spool_sync=1.0, cache_bytes=1024*1024,
+                 dedup_window=0, dedup_masks=None, ingest_workers=0,
+                 profile_dir=None, profile_seconds=30):
+
+        self.networks = OrderedDict()
+        self.script = map(decode, script or [])
+        self.listen_addrs = listen_addrs or []
+        self.listeners = []
+        self.unix_paths = []
+        self.backlog = backlog
+
+        self.router = Router(routes)
+        if self.script:
+            self.router.set_default('^!', self.script)
+        self.watcher = None
+
+        self.reactor = Reactor()
+        self.dispatchers = self.reactor.dispatchers
+
+        self.recv_buffers = {}
+        self.recv_size = recv_size
+        self.max_line = max_line
+
+        self.tracer = trace
+        self.profiler = Profiler(self.reactor,
+            profile_dir or tempfile.gettempdir(), profile_seconds)
+        self.metrics = Metrics()
+        self.stats_addr = stats_addr
+        self.stats_clients = {}
+        self.http_addr = http_addr
+        self.http_listener = None
+        self.http_clients = {}
+
+        # Listener clients stop being read while a send queue is too long
+        self.queue_high = queue_high
+        self.queue_low = queue_low
+        self.readers = set()
+        self.paused = {}
+        self.backpressure = False
+
+        # Limits that keep connection storms and stuck clients in check
+        self.clients = {}
+        self.client_counts = {}
+        self.max_clients = max_clients
+        self.max_clients_per_ip = max_clients_per_ip
+        self.client_idle = client_idle
+        self.client_deadline = client_deadline
+        self.client_max_bytes = client_max_bytes
+
+        # Coprocess mode keeps this many script workers running
+        self.worker_count = workers
+        self.workers = []
+        self.requests = deque()
+        self.request_id = 0
+        self.script_queue = script_queue
+
+        self.resolver = Resolver(self.reactor)
+        self.supervisor = Supervisor(self.reactor, max_scripts, script_queue,
+            script_timeout, metrics=self.metrics)
+        self.nick_limiter = nick_rate and RateLimiter(nick_rate)
+        self.channel_limiter = channel_rate and RateLimiter(channel_rate)
+
+        # Replies to repeated commands, enabled by the script's config
+        self.cache = ResponseCache(cache_bytes)
+
+        # Accepted messages are kept on disk until sent when spooling
+        self.spool = None
+        self.spool_path = spool
+        self.spool_ttl = spool_ttl
+        self.spool_sync = spool_sync
+
+        # Repeated messages are collapsed into a summary when enabled
+        self.dedup = None
+        if dedup_window:
+            self.dedup = Deduplicator(self.reactor, dedup_window,
+                self.deliver, dedup_masks)
+
+        # Listener clients are spread over this many ingest worker processes
+        self.ingest_count = ingest_workers
+        self.ingest_workers = {}
+        self.ingest_snapshot = None
+        self.ingest_records = 0
+        self.snapshot_timer = None
+
+        # Set when we are an ingest worker, the socket to the relay
+        self.upstream = None
+        self.upstream_output = []
+        self.upstream_timer = None
+        self.accepting = False
+        self.inherited = self.load_ingest()
+
+        if self.upstream:
+            self.ingest_count = 0
+
+        # State left to us by the process we replaced on a hot restart
+        self.handover = self.load_handover()
+
+        self.setup_listener()
+        self.setup_spool()
+        self.setup_metrics()
+        self.setup_stats()
+        self.setup_http()
+
+        self.running = False
+
+    ## Init helpers ##
+    def setup_listener(self):
+        if self.handover:
+            self.adopt_listeners()
+            return
+        elif not self.listen_addrs:
+            logging.debug('No listener, stopping listener setup')
+            return
+
+        for scheme, fd, family, socktype in self.inherited:
+            self.add_listener(scheme, self.adopt_socket(fd, family, socktype))
+
+        for scheme, address in self.listen_addrs:
+            unix = scheme in ('unix', 'unixgram')
+
+            if self.ingest_count and not unix:
+                continue # Each ingest worker binds these with SO_REUSEPORT
+            elif self.upstream and unix:
+                continue # Inherited from the relay
+
+            try:
+                listener = self.create_listener(scheme, address)
+            except socket.error, e:
+                logging.error('Could not setup %s listener on %s: %s',
+                    scheme, address, e)
+                continue
+
+            self.add_listener(scheme, listener)
+
+    def add_listener(self, scheme, listener):
+        logging.info('Listener set up on %s://%s', scheme,
+            format_address(listener.getsockname()))
+
+        self.listeners.append((scheme, listener))
+
+        if self.ingest_count:
+            return # Only kept for the ingest workers to inherit
+        elif listener.type == socket.SOCK_STREAM:
+            self.reactor.register(listener, self.handle_listener)
+        else:
+            # Datagram sockets are paused along with the stream clients
+            self.recv_buffers[listener] = LineFramer(self.max_line)
+            self.readers.add(listener)
+            self.reactor.register(listener, self.handle_datagram)
+
+    def load_ingest(self):
+        '''
+        Pick up the socket to the relay when started as an ingest worker,
+        returns the listeners we inherited.
+        '''
+
+        ingest = os.environ.pop(self.INGEST_ENV, None)
+
+        if ingest is None:
+            return []
+
+        ingest = json.loads(ingest)
+
+        self.upstream = self.adopt_socket(ingest['upstream'], socket.AF_UNIX,
+            socket.SOCK_STREAM)
+        self.upstream.setblocking(1)
+        self.upstream_framer = LineFramer(self.INGEST_MAX_LINE)
+
+        return ingest['listeners']
+
+    def adopt_socket(self, fd, family, socktype):
+        '''Socket object for an fd we inherited, closing the original'''
+
+        sock = socket.fromfd(fd, family, socktype)
+        sock.setblocking(0)
+        os.close(fd)
+        return sock
+
+    def load_handover(self):
+        fd = os.environ.pop(self.RESTART_ENV, None)
+
+        if fd is None:
+            return None
+
+        try:
+            handover = os.fdopen(int(fd), 'rb')
+            state = json.loads(handover.read())
+            handover.close()
+        except (ValueError, IOError, OSError), e:
+            logging.error('Could not read state from previous process: %s', e)
+            return None
+
+        return state
+
+    def adopt_listeners(self):
+        '''Take over the listeners and clients of the process we replaced'''
+
+        for scheme, fd, family, socktype in self.handover['listeners']:
+            self.add_listener(scheme, self.adopt_socket(fd, family, socktype))
+
+        self.unix_paths = self.handover['unix_paths']
+
+        for fd, family, peer, last, partial, received, buffered in \
+                self.handover['clients']:
+            conn = self.adopt_socket(fd, family, socket.SOCK_STREAM)
+            self.add_client(conn, peer)
+
+            client = self.clients[conn]
+            client.last, client.partial = last, partial
+            client.received = received
+            self.schedule_client_timeout(conn, client)
+
+            if buffered:
+                self.recv_buffers[conn] = LineFramer(self.max_line)
+                self.recv_buffers[conn].feed(buffered.decode('base64'))
+
+        logging.info('Took over %d listeners and %d clients',
+            len(self.listeners), len(self.clients))
+
+    def create_listener(self, scheme, address):
+        if scheme in ('unix', 'unixgram'):
+            family = socket.AF_UNIX
+        elif not address[0] and socket.has_ipv6:
+            family = socket.AF_INET6
+            address = ('::', address[1])
+        else:
+            family, socktype, proto, name, address = socket.getaddrinfo(
+                address[0], address[1], socket.AF_UNSPEC, 0, 0,
+                socket.AI_PASSIVE)[0]
+
+        if scheme in ('tcp', 'unix'):
+            listener = socket.socket(family, socket.SOCK_STREAM)
+        else:
+            listener = socket.socket(family, socket.SOCK_DGRAM)
+
+        listener.setblocking(0)
+
+        if family == socket.AF_UNIX:
+            # Left behind by an earlier run that did not clean up
+            try:
+                if stat.S_ISSOCK(os.stat(address).st_mode):
+                    os.unlink(address)
+            except OSError:
+                pass
+        else:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        if self.upstream and family != socket.AF_UNIX:
+            # Let the kernel spread clients over the ingest workers
+            listener.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+
+        if family == socket.AF_INET6 and address[0] == '::':
+            # Dual-stack, IPv4 clients show up as ::ffff:a.b.c.d
+            listener.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+
+        try:
+            listener.bind(address)
+        except socket.error:
+            if family != socket.AF_INET6 or address[0] != '::':
+                raise
+            # No IPv6 on this host after all
+            listener.close()
+            return self.create_listener(scheme, ('0.0.0.0', address[1]))
+
+        if family == socket.AF_UNIX:
+            self.unix_paths.append(address)
+
+        if listener.type == socket.SOCK_STREAM:
+            listener.listen(self.backlog)
+
+        return listener
+
+    def setup_spool(self):
+        if not self.spool_path or self.upstream:
+            return
+
+        try:
+            self.spool = Spool(self.reactor, self.spool_path, self.spool_ttl,
+                self.spool_sync)
+        except (IOError, OSError), e:
+            logging.error('Could not open spool in %s: %s', self.spool_path, e)
+            return
+
+        logging.info('Spooling messages to %s', self.spool_path)
+
+    def setup_metrics(self):
+        metrics = self.metrics
+        supervisor = self.supervisor
+        per_network = self.per_network
+
+        metrics.register('pycat_sent_lines_total', 'counter',
+            'Lines sent to the IRC server')
+        metrics.register('pycat_sent_bytes_total', 'counter',
+            'Bytes sent to the IRC server')
+        metrics.register('pycat_send_latency_seconds', 'histogram',
+            'Time lines spent in the send queue')
+        metrics.register('pycat_queued_lines_total', 'counter',
+            'Lines queued for sending per source')
+        metrics.register('pycat_send_queue_lines', 'gauge',
+            'Lines waiting in the send queue',
+            per_network(lambda n: len(n.send_buffer)))
+        metrics.register('pycat_send_queue_high_water_lines', 'gauge',
+            'Most lines ever waiting in the send queue',
+            per_network(lambda n: n.send_buffer.high_water))
+        metrics.register('pycat_send_queue_dropped_total', 'counter',
+            'Lines dropped by the queue overflow policy',
+            per_network(lambda n: n.send_buffer.dropped))
+        metrics.register('pycat_throttle_delay_seconds', 'gauge',
+            'Time until the next queued line may be sent',
+            per_network(lambda n: n.send_buffer and n.send_bucket.delay()
+                or 0))
+        metrics.register('pycat_received_lines_total', 'counter',
+            'Lines received from listener clients per peer')
+        metrics.register('pycat_received_bytes_total', 'counter',
+            'Bytes received from listener clients per peer')
+        metrics.register('pycat_listener_connections_total', 'counter',
+            'Connections accepted by the listener per peer')
+        metrics.register('pycat_listener_clients', 'gauge',
+            'Connected listener clients', lambda: len(self.clients))
+        metrics.register('pycat_listener_rejected_total', 'counter',
+            'Connections turned away by the client limits')
+        metrics.register('pycat_listener_closed_total', 'counter',
+            'Clients disconnected for breaking a limit')
+        metrics.register('pycat_listener_paused_clients', 'gauge',
+            'Listener clients paused by backpressure',
+            lambda: len(self.paused))
+        metrics.register('pycat_script_spawns_total', 'counter',
+            'Script processes started', lambda: supervisor.spawned)
+        metrics.register('pycat_script_timeouts_total', 'counter',
+            'Script processes terminated for taking too long',
+            lambda: supervisor.timeouts)
+        metrics.register('pycat_script_duration_seconds', 'histogram',
+            'Script process run time')
+        metrics.register('pycat_scripts_running', 'gauge',
+            'Script processes counting against --max-scripts',
+            lambda: supervisor.running)
+        metrics.register('pycat_scripts_waiting', 'gauge',
+            'Script invocations waiting for a free slot',
+            lambda: len(supervisor.waiting))
+        metrics.register('pycat_http_requests_total', 'counter',
+            'Requests to the HTTP ingest listener per status code')
+        metrics.register('pycat_http_clients', 'gauge',
+            'Connected HTTP ingest clients', lambda: len(self.http_clients))
+        metrics.register('pycat_connects_total', 'counter',
+            'Attempts to connect to an IRC server')
+        metrics.register('pycat_connect_failures_total', 'counter',
+            'Failed attempts to connect to an IRC server')
+        metrics.register('pycat_disconnects_total', 'counter',
+            'Disconnects from the IRC server')
+        metrics.register('pycat_connected', 'gauge',
+            'Whether the IRC connection is up',
+            per_network(lambda n: int(n.connection.is_connected())))
+        metrics.register('pycat_server_health', 'gauge',
+            'Decaying share of connects to a server that got us registered',
+            self.per_server(lambda s: s.health))
+        metrics.register('pycat_server_register_seconds', 'gauge',
+            'Decaying average of how long registering with a server takes',
+            self.per_server(lambda s: s.latency))
+        metrics.register('pycat_spool_messages', 'gauge',
+            'Spooled messages that have not been sent yet',
+            lambda: self.spool and len(self.spool.pending) or 0)
+        metrics.register('pycat_spool_segments', 'gauge',
+            'Segment files in the spool',
+            lambda: self.spool and len(self.spool.segments) or 0)
+        metrics.register('pycat_spool_expired_total', 'counter',
+            'Spooled messages dropped for outliving --spool-ttl',
+            lambda: self.spool and self.spool.expired or 0)
+        metrics.register('pycat_cache_hits_total', 'counter',
+            'Script commands answered from the reply cache',
+            lambda: self.cache.hits)
+        metrics.register('pycat_cache_misses_total', 'counter',
+            'Cacheable script commands that had to run the script',
+            lambda: self.cache.misses)
+        metrics.register('pycat_cache_entries', 'gauge',
+            'Replies in the reply cache', lambda: len(self.cache.entries))
+        metrics.register('pycat_cache_bytes', 'gauge',
+            'Bytes of replies in the reply cache', lambda: self.cache.size)
+        metrics.register('pycat_ingest_workers', 'gauge',
+            'Running ingest worker processes',
+            lambda: len(self.ingest_workers))
+        metrics.register('pycat_ingest_records_total', 'counter',
+            'Messages received from ingest workers',
+            lambda: self.ingest_records)
+        metrics.register('pycat_dedup_suppressed_total', 'counter',
+            'Repeated messages held back by the deduplication window',
+            lambda: self.dedup and self.dedup.suppressed or 0)
+        metrics.register('pycat_dedup_summaries_total', 'counter',
+            'Summaries sent in place of repeated messages',
+            lambda: self.dedup and self.dedup.summaries or 0)
+        metrics.register('pycat_dedup_messages', 'gauge',
+            'Messages being watched for repeats',
+            lambda: self.dedup and len(self.dedup.entries) or 0)
+
+    def setup_stats(self):
+        if not self.stats_addr or self.upstream:
+            return
+
+        try:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setblocking(0)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind(self.stats_addr)
+            listener.listen(self.backlog)
+        except socket.error, e:
+            logging.error('Could not setup stats listener: %s', e)
+            return
+
+        logging.info('Stats listener set up on %s:%s' % self.stats_addr)
+        self.reactor.register(listener, self.handle_stats_listener)
+
+    def setup_http(self):
+        if not self.http_addr or self.upstream:
+            return
+        elif self.handover and self.handover['http'] is not None:
+            listener = socket.fromfd(self.handover['http'], socket.AF_INET,
+                socket.SOCK_STREAM)
+            listener.setblocking(0)
+            os.close(self.handover['http'])
+        else:
+            try:
+                listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                listener.setblocking(0)
+                listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                listener.bind(self.http_addr)
+                listener.listen(self.backlog)
+            except socket.error, e:
+                logging.error('Could not setup HTTP listener: %s', e)
+                return
+
+        logging.info('HTTP listener set up on %s:%s' % self.http_addr)
+        self.http_listener = listener
+        self.reactor.register(listener, self.handle_http_listener)
+
+    def add_network(self, network):
+        self.networks[network.name] = network
+
+    def per_network(self, function):
+        '''Metric callback giving the value of function for each network'''
+
+        return lambda: dict(((('network', name),), function(network))
+            for name, network in self.networks.items())
+
+    def per_server(self, function):
+        '''Metric callback giving the value of function for each server'''
+
+        def values():
+            for name, network in self.networks.items():
+                for server in network.servers:
+                    value = function(server)
+                    if value is not None:
+                        yield (('network', name), ('server', str(server))), \
+                            value
+
+        return lambda: dict(values())
+
+    ## Event loop and cleanup code ##
+    def start(self):
+        self.reactor.add_signal_handler(signal.SIGUSR1, self.handle_profile)
+
+        if self.upstream:
+            self.run_ingest()
+            return
+
+        for network in self.networks.values():
+            network.start()
+
+        self.running = True
+
+        if self.handover:
+            self.supervisor.adopt(self.handover['orphans'])
+            self.adopt_ingest()
+            self.handover = None
+
+        self.start_ingest()
+
+        self.reactor.add_signal_handler(signal.SIGUSR2, self.handle_restart)
+
+        if self.script:
+            self.watcher = FileWatcher(self.reactor, self.script[0],
+                self.handle_script_changed)
+            self.reload_config()
+
+        self.start_workers()
+
+        while self.running:
+            self.reactor.run_once()
+
+    def stop(self):
+        self.profiler.stop()
+
+        if self.upstream:
+            self.flush_upstream()
+            self.upstream.close()
+            self.reactor.close()
+            return
+
+        if self.watcher:
+            self.watcher.close()
+
+        self.stop_workers()
+        self.supervisor.stop()
+
+        for network in self.networks.values():
+            network.stop()
+
+        for worker in self.ingest_workers.values():
+            self.stop_ingest(worker)
+        self.reactor.cancel(self.snapshot_timer)
+
+        for sock in self.paused:
+            sock.close()
+
+        self.reactor.close()
+
+        for path in self.unix_paths:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+        if self.dedup:
+            self.dedup.close()
+
+        if self.spool:
+            self.spool.close()
+
+        if self.tracer:
+            self.tracer.close()
+
+        self.resolver.close()
+
+    ##  Event loop handlers ##
+
+    # Listener handlers
+    def handle_listener(self, sock):
+        for conn, addr in self.accept(sock):
+            peer = self.peer_name(addr, sock)
+            logging.debug('%s connected', peer)
+            self.metrics.inc('pycat_listener_connections_total', peer=peer)
+
+            if self.tracer and self.tracer.sampled():
+                self.tracer.event('accept', fd=conn.fileno(), peer=peer)
+
+            if not self.connected() and not self.spool:
+                logging.warning('%s disconnected as irc is down', peer)
+                conn.close()
+            elif self.reject(conn, peer):
+                continue
+            else:
+                self.add_client(conn, peer)
+
+    def handle_reciver(self, sock):
+        client = self.clients[sock]
+        peer = client.peer
+
+        try:
+            data = sock.recv(self.recv_size)
+        except socket.error, e:
+            data = ''
+            logging.error('%s %s', peer, e)
+
+        if self.tracer and self.tracer.sampled():
+            self.tracer.event('recv', fd=self.reactor.filenos.get(sock),
+                peer=peer, bytes=len(data), queue=self.queued())
+
+        self.metrics.inc('pycat_received_bytes_total', len(data), peer=peer)
+
+        client.last = monotonic()
+        client.received += len(data)
+
+        if self.client_max_bytes and client.received > self.client_max_bytes:
+            self.close_client(sock, 'sent more than %d bytes' %
+                self.client_max_bytes)
+            return
+
+        for line in self.process_data(sock, data):
+            self.relay_line(line, peer)
+
+        if len(data) == 0:
+            logging.debug('%s disconnected', peer)
+            self.remove_client(sock)
+        elif not self.recv_buffers[sock]:
+            client.partial = None
+        elif client.partial is None:
+            client.partial = client.last
+            self.schedule_client_timeout(sock, client)
+
+    def handle_client_timeout(self, sock):
+        client = self.clients[sock]
+        client.timer = None
+        now = monotonic()
+
+        if sock in self.paused:
+            # Not their fault that we stopped reading
+            client.last = now
+            if client.partial is not None:
+                client.partial = now
+        elif self.client_idle and now - client.last >= self.client_idle:
+            self.close_client(sock, 'idle for %ds' % self.client_idle)
+            return
+        elif self.client_deadline and client.partial is not None and \
+                now - client.partial >= self.client_deadline:
+            self.close_client(sock, 'no newline within %ds' %
+                self.client_deadline)
+            return
+
+        self.schedule_client_timeout(sock, client)
+
+    def handle_datagram(self, sock):
+        framer = self.recv_buffers[sock]
+
+        # Stop early if a line we relayed made us pause the listeners
+        for i in range(self.DATAGRAM_BATCH):
+            if sock not in self.dispatchers:
+                break
+
+            try:
+                data, addr = sock.recvfrom(65536)
+            except socket.error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    logging.error('Could not read datagram: %s', e)
+                break
+
+            peer = self.peer_name(addr, sock)
+
+            if self.tracer and self.tracer.sampled():
+                self.tracer.event('recv', fd=self.reactor.filenos.get(sock),
+                    peer=peer, bytes=len(data), queue=self.queued())
+
+            self.metrics.inc('pycat_received_bytes_total', len(data),
+                peer=peer)
+
+            # Each datagram is complete, even without a trailing newline
+            for line in framer.feed(data + '\n'):
+                self.relay_line(line, peer)
+
+    # Process handlers
+    def handle_stdout(self, sock, network, target, source, name=None,
+                      key=None):
+        data = self.read_pipe(sock)
+
+        for line in self.process_data(sock, data):
+            self.send_reply(network, line, target, source, name)
+
+            if key:
+                self.cache.pending[key][0].append(line)
+
+        if key and len(data) == 0:
+            self.finish_cached(key, name)
+
+    def handle_stderr(self, sock, name=None):
+        data = self.read_pipe(sock)
+
+        for line in self.process_data(sock, data):
+            logging.error('%s %s', name or self.script[0], line)
+
+    # Stats handlers
+    def handle_stats_listener(self, sock):
+        for conn, addr in self.accept(sock):
+            conn.setblocking(0)
+
+            # Request read so far, timer and the response being sent
+            timer = self.reactor.call_later(10, self.close_stats, conn)
+            self.stats_clients[conn] = ['', timer, None]
+            self.reactor.register(conn, self.handle_stats)
+
+    def handle_stats(self, sock):
+        try:
+            data = sock.recv(self.recv_size)
+        except socket.error:
+            data = ''
+
+        if self.stats_clients[sock][2] is not None:
+            if not data:
+                self.close_stats(sock) # Gave up before getting all of it
+            return
+
+        request = self.stats_clients[sock][0] + data
+
+        if data and '\r\n\r\n' not in request and len(request) < 8192:
+            self.stats_clients[sock][0] = request
+            return
+
+        if not request:
+            self.close_stats(sock)
+            return
+        elif request.startswith('GET /debug ') and \
+                not self.is_loopback(sock):
+            # The report walks every object, not for anyone who can connect
+            response = 'HTTP/1.0 403 Forbidden\r\n\r\n'
+        elif request.startswith('GET /debug '):
+            body = self.debug_report()
+            response = ('HTTP/1.0 200 OK\r\n'
+                'Content-Type: text/plain; charset=utf-8\r\n'
+                'Content-Length: %d\r\n'
+                'Connection: close\r\n\r\n' % len(body)) + body
+        elif request.startswith('GET '):
+            body = self.metrics.render()
+            response = ('HTTP/1.0 200 OK\r\n'
+                'Content-Type: text/plain; version=0.0.4\r\n'
+                'Content-Length: %d\r\n'
+                'Connection: close\r\n\r\n' % len(body)) + body
+        else:
+            response = 'HTTP/1.0 405 Method Not Allowed\r\n\r\n'
+
+        self.stats_clients[sock][2] = response
+        self.handle_stats_writable(sock)
+
+    def handle_stats_writable(self, sock):
+        response = self.stats_clients[sock][2]
+
+        try:
+            sent = sock.send(response)
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                logging.warning('Could not send stats: %s', e)
+                self.close_stats(sock)
+                return
+            sent = 0
+
+        self.stats_clients[sock][2] = response[sent:]
+
+        if response[sent:]:
+            self.reactor.register_writer(sock, self.handle_stats_writable)
+        else:
+            self.close_stats(sock)
+
+    # HTTP ingest handlers
+    def handle_http_listener(self, sock):
+        for conn, addr in self.accept(sock):
+            peer = self.peer_name(addr, sock)
+            conn.setblocking(0)
+            logging.debug('%s connected over HTTP', peer)
+
+            if self.tracer and self.tracer.sampled():
+                self.tracer.event('accept', fd=conn.fileno(), peer=peer,
+                    http=True)
+
+            if self.reject(conn, peer):
+                continue
+
+            client = HTTPClient(peer)
+            client.timer = self.reactor.call_later(self.HTTP_IDLE,
+                self.close_http, conn)
+            self.http_clients[conn] = client
+            self.client_counts[peer] = self.client_counts.get(peer, 0) + 1
+            self.reactor.register(conn, self.handle_http)
+
+    def handle_http(self, sock):
+        client = self.http_clients[sock]
+
+        try:
+            data = sock.recv(self.recv_size)
+        except socket.error, e:
+            data = ''
+            logging.error('%s %s', client.peer, e)
+
+        if len(data) == 0:
+            logging.debug('%s disconnected from HTTP', client.peer)
+            self.close_http(sock)
+            return
+
+        client.data += data
+        self.reactor.cancel(client.timer)
+        client.timer = self.reactor.call_later(self.HTTP_IDLE,
+            self.close_http, sock)
+
+        # Keep going as clients may pipeline several requests
+        while not client.closing:
+            end = client.data.find('\r\n\r\n')
+
+            if end < 0:
+                if len(client.data) > self.HTTP_MAX_HEADER:
+                    self.send_http(sock, 431,
+                        {'error': 'request header too large'}, False)
+                return
+
+            head = client.data[:end].split('\r\n')
+            request = head[0].split()
+            headers = {}
+
+            for line in head[1:]:
+                if ':' in line:
+                    key, value = line.split(':', 1)
+                    headers[key.strip().lower()] = value.strip()
+
+            if len(request) != 3 or not request[2].startswith('HTTP/'):
+                self.send_http(sock, 400, {'error': 'bad request line'}, False)
+                return
+
+            method, path, version = request
+            connection = headers.get('connection', '').lower()
+            keep_alive = connection == 'keep-alive' or \
+                (version == 'HTTP/1.1' and connection != 'close')
+
+            if 'chunked' in headers.get('transfer-encoding', '').lower():
+                self.send_http(sock, 411,
+                    {'error': 'chunked bodies are not supported'}, False)
+                return
+
+            try:
+                length = int(headers.get('content-length', 0))
+            except ValueError:
+                length = -1
+
+            if length < 0 or length > self.HTTP_MAX_BODY:
+                self.send_http(sock, 413, {'error': 'bad content length'},
+                    False)
+                return
+
+            if len(client.data) < end + 4 + length:
+                return # Wait for the rest of the body
+
+            body = client.data[end + 4:end + 4 + length]
+            client.data = client.data[end + 4 + length:]
+
+            status, reply = self.http_request(method, body, client.peer)
+            self.send_http(sock, status, reply, keep_alive)
+
+    def handle_http_writable(self, sock):
+        client = self.http_clients[sock]
+
+        try:
+            sent = sock.send(client.output)
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                logging.warning('%s %s', client.peer, e)
+                self.close_http(sock)
+                return
+            sent = 0
+
+        client.output = client.output[sent:]
+
+        if client.output:
+            self.reactor.register_writer(sock, self.handle_http_writable)
+        else:
+            self.reactor.unregister_writer(sock)
+
+            if client.closing:
+                self.close_http(sock)
+
+    def handle_script_changed(self):
+        logging.info('%s changed, reloading config', self.script[0])
+        self.cache.clear()
+
+        if self.reload_config():
+            self.retire_workers()
+
+    def handle_restart(self):
+        '''
+        Make sure the new pycat.py at least loads before replacing us, the
+        check runs under the supervisor and restarts us once it exits.
+        '''
+
+        check = 'import imp, sys; imp.load_source("pycat_check", sys.argv[1])'
+        output = []
+
+        def started(process):
+            self.reactor.register(process.stdout,
+                lambda pipe: output.append(self.read_check(pipe)))
+
+        def exited(process):
+            if not process.stdout.closed:
+                output.append(process.stdout.read())
+                self.read_check(process.stdout, '')
+
+            if process.returncode != 0:
+                logging.error('Not restarting, %s does not load: %s',
+                    sys.argv[0], (''.join(output).strip().splitlines() or
+                    [''])[-1])
+            elif self.running:
+                self.restart()
+
+        if not self.supervisor.spawn([sys.executable, '-c', check,
+                sys.argv[0]], started, limited=False, exited=exited,
+                stderr=subprocess.STDOUT, name='restart check'):
+            logging.error('Not restarting, could not check %s', sys.argv[0])
+
+    def read_check(self, pipe, data=None):
+        if data is None:
+            data = self.read_pipe(pipe)
+
+        if not data:
+            self.reactor.unregister(pipe)
+            pipe.close()
+
+        return data
+
+    def restart(self):
+        '''
+        Replace this process with a fresh pycat from the same command line,
+        handing over the listeners, clients, ingest workers and IRC
+        connections through exec along with a dump of the state that goes
+        with them.
+        '''
+
+        logging.info('Restarting, handing over to a new process')
+
+        state, fds = self.dump_state()
+
+        handover = tempfile.TemporaryFile()
+        handover.write(json.dumps(state))
+        handover.flush()
+        handover.seek(0)
+        fds.add(handover.fileno())
+
+        # Everything else, including script pipes, is closed by the exec
+        keep_on_exec(fds)
+
+        env = dict(os.environ)
+        env[self.RESTART_ENV] = str(handover.fileno())
+
+        # Scripts can't be handed over, the new process reaps them. Should
+        # the exec fail workers are replaced as they exit, like on a reload.
+        self.retire_workers()
+        self.supervisor.stop(set(pid for pid, fd, buffered in
+            state['ingest']))
+
+        try:
+            os.execve(sys.executable, [sys.executable] + sys.argv, env)
+        except OSError, e:
+            logging.error('Could not restart, carrying on: %s', e)
+            handover.close()
+
+    def handle_config(self, sock, config):
+        data = self.read_pipe(sock)
+
+        for line in self.process_data(sock, data):
+            # XXX use shlex or other suitable scheme to parse this with respect
+            #     to leading and trailing whitespace and "' handling
+            match = re.match('^(?P<key>\w+)\s*=\s*(?P<value>.+)', line)
+
+            if not match:
+                logging.error("Invalid reply from %s: '%s'", self.script[0], line)
+                continue
+
+            key, value = match.groups()
+
+            if key == 'match': # If this grows a dispatcher table may be better
+                self.router.set_default(value, self.script)
+                logging.info("Setting match regexp to '%s'", value)
+            elif key == 'route' and len(value.split(None, 1)) == 2:
+                script, match = value.split(None, 1)
+                config['routes'].append((match, [script]))
+                logging.info("Routing '%s' to %s", match, script)
+            elif key == 'cache' and re.match('^\d+$', value):
+                config['cache'] = int(value)
+                logging.info('Caching replies for %s seconds', value)
+            else:
+                logging.warning("Unknown config key: %s = '%s'", key, value)
+
+        if len(data) == 0:
+            self.router.set_config_routes(config['routes'])
+            self.cache.ttl = config['cache']
+
+    def handle_worker(self, sock, worker):
+        data = self.read_pipe(sock)
+
+        for line in self.process_data(sock, data):
+            try:
+                reply = json.loads(line)
+            except ValueError, e:
+                logging.error("Invalid reply from %s pid:%s: '%s'",
+                    self.script[0], worker.process.pid, line)
+                continue
+
+            if not worker.request or reply.get('id') != worker.request[0]:
+                logging.warning('%s pid:%s replied to unknown request %s',
+                    self.script[0], worker.process.pid, reply.get('id'))
+                continue
+
+            request_id, request, network, target, source, key = worker.request
+
+            if reply.get('message'):
+                self.send_reply(network, reply['message'], target, source)
+
+                if key:
+                    self.cache.pending[key][0].append(reply['message'])
+
+            if reply.get('done'):
+                if key:
+                    self.finish_cached(key)
+                self.finish_request(worker)
+
+        if len(data) == 0:
+            self.handle_worker_exit(worker)
+
+    def handle_worker_exit(self, worker):
+        if worker.request:
+            logging.error('%s pid:%s exited while handling request %s',
+                self.script[0], worker.process.pid, worker.request[0])
+
+            if worker.request[5]:
+                self.finish_cached(worker.request[5], store=False)
+        else:
+            logging.info('%s pid:%s exited', self.script[0],
+                worker.process.pid)
+
+        self.reactor.cancel(worker.timer)
+        self.workers.remove(worker)
+        worker.process.stdin.close()
+
+        if self.running:
+            self.reactor.call_later(1, self.start_workers)
+
+    def handle_worker_timeout(self, worker):
+        logging.error('%s pid:%s taking to long with request %s, '
+            'sending SIGTERM', self.script[0], worker.process.pid,
+            worker.request[0])
+        worker.timer = None
+        self.supervisor.timeouts += 1
+        self.supervisor.terminate(worker.process)
+
+    # Ingest worker handlers
+    def handle_ingest(self, sock):
+        worker = self.ingest_workers[sock]
+
+        try:
+            data = sock.recv(65536)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ''
+
+        for line in worker.framer.feed(data):
+            try:
+                name, targets, message, source = json.loads(line)
+            except (ValueError, TypeError):
+                logging.error("Invalid record from ingest worker pid:%s: '%s'",
+                    worker.process.pid, line)
+                continue
+
+            if name in self.networks:
+                self.ingest_records += 1
+                self.send(self.networks[name], message, targets, source)
+
+        if not data:
+            logging.error('Ingest worker pid:%s exited', worker.process.pid)
+            self.stop_ingest(worker)
+
+            if self.running:
+                self.reactor.call_later(1, self.start_ingest)
+
+    def handle_ingest_writable(self, sock):
+        worker = self.ingest_workers[sock]
+
+        try:
+            sent = sock.send(worker.output)
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                worker.output = '' # Read handler will clean up
+            sent = 0
+
+        worker.output = worker.output[sent:]
+
+        if worker.output:
+            self.reactor.register_writer(sock, self.handle_ingest_writable)
+        else:
+            self.reactor.unregister_writer(sock)
+
+    def handle_snapshot(self):
+        self.snapshot_timer = self.reactor.call_later(self.SNAPSHOT_INTERVAL,
+            self.handle_snapshot)
+
+        snapshot = json.dumps(self.snapshot(), sort_keys=True)
+
+        if snapshot != self.ingest_snapshot:
+            self.ingest_snapshot = snapshot
+            for worker in self.ingest_workers.values():
+                self.send_ingest(worker, snapshot)
+
+    def handle_upstream(self, sock):
+        try:
+            data = sock.recv(65536)
+        except socket.error, e:
+            logging.error('Could not read from relay: %s', e)
+            data = ''
+
+        if not data:
+            logging.info('Relay went away, stopping ingest worker')
+            self.running = False
+            return
+
+        for line in self.upstream_framer.feed(data):
+            update = json.loads(line)
+
+            for name, snapshot in update.get('networks', {}).items():
+                if name in self.networks:
+                    self.networks[name].update(snapshot)
+
+            self.accepting = update.get('accepting', self.accepting)
+
+            if update.get('paused') and not self.backpressure:
+                self.pause_clients()
+            elif update.get('paused') is False and self.backpressure:
+                self.resume_clients()
+
+    # Profiling handler
+    def handle_profile(self):
+        '''Toggle profiling on SIGUSR1 and write a debug report'''
+
+        path = self.profiler.path('txt')
+        try:
+            report = open(path, 'w')
+            report.write(self.debug_report())
+            report.close()
+            logging.info('Debug report written to %s', path)
+        except (IOError, OSError), e:
+            logging.error('Could not write debug report: %s', e)
+
+        if self.profiler.profile:
+            self.profiler.stop()
+        else:
+            self.profiler.start()
+
+    ## Event loop helper methods ##
+    def is_loopback(self, sock):
+        try:
+            return sock.getpeername()[0].startswith('127.')
+        except socket.error:
+            return False
+
+    def close_stats(self, sock):
+        buffered, timer, response = self.stats_clients.pop(sock)
+        self.reactor.cancel(timer)
+        self.reactor.unregister(sock)
+        sock.close()
+
+    def debug_report(self):
+        '''
+        Dispatcher table with what each fd has buffered, followed by queue
+        sizes and the live objects that changed most since the last report.
+        '''
+
+        reactor = self.reactor
+        lines = ['%5s %-40s %6s %10s %10s' % ('fd', 'handler', 'writer',
+            'read', 'write')]
+
+        for sock, handler in sorted(reactor.dispatchers.items(),
+                                    key=lambda item: reactor.filenos[item[0]]):
+            reading, writing = self.buffered(sock)
+            lines.append('%5d %-40s %6s %10d %10d' % (reactor.filenos[sock],
+                handler_name(handler), sock in reactor.writers and 'yes' or '',
+                reading, writing))
+
+        lines.append('')
+        lines.append('%d timers, %d recv buffers holding %d bytes' % (
+            len(reactor.timers), len(self.recv_buffers),
+            sum(len(framer) for framer in self.recv_buffers.values())))
+
+        if not self.upstream:
+            for network in self.networks.values():
+                lines.append('%s: %d queued lines, %d sent awaiting spool '
+                    'ack' % (network.name, len(network.send_buffer),
+                             len(network.spool_lines)))
+
+        lines.append('')
+        lines.append('%-50s %10s %10s' % ('type', 'objects', 'change'))
+
+        for name, count, change in self.profiler.count_objects()[:30]:
+            lines.append('%-50s %10d %+10d' % (name, count, change))
+
+        return '\n'.join(lines) + '\n'
+
+    def buffered(self, sock):
+        '''Returns bytes waiting to be read as lines and to be written'''
+
+        reading, writing = 0, 0
+
+        if sock in self.recv_buffers:
+            reading += len(self.recv_buffers[sock])
+        if sock in self.stats_clients:
+            reading += len(self.stats_clients[sock][0])
+            writing += len(self.stats_clients[sock][2] or '')
+        if sock in self.http_clients:
+            reading += len(self.http_clients[sock].data)
+            writing += len(self.http_clients[sock].output)
+        if sock in self.ingest_workers:
+            reading += len(self.ingest_workers[sock].framer)
+            writing += len(self.ingest_workers[sock].output)
+        if sock is self.upstream:
+            reading += len(self.upstream_framer)
+            writing += sum(len(line) + 1 for line in self.upstream_output)
+
+        return reading, writing
+
+    def accept(self, sock):
+        '''Accept every pending connection on a non-blocking listener'''
+
+        while True:
+            try:
+                conn, addr = sock.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EINTR, errno.ECONNABORTED):
+                    continue
+                elif e.args[0] in (errno.EMFILE, errno.ENFILE,
+                                   errno.ENOBUFS, errno.ENOMEM):
+                    # The pending connection keeps the listener readable,
+                    # so stop polling it for a while instead of spinning
+                    logging.error('Could not accept connection: %s', e)
+                    handler = self.dispatchers[sock]
+                    self.reactor.unregister(sock)
+                    self.reactor.call_later(1, self.reactor.register, sock,
+                        handler)
+                elif e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    logging.error('Could not accept connection: %s', e)
+                return
+
+            yield conn, addr
+
+    def reject(self, conn, peer):
+        '''Close conn if it would break a client limit, returns True if so'''
+
+        if self.max_clients and \
+                len(self.clients) + len(self.http_clients) >= self.max_clients:
+            reason = 'too many clients'
+        elif self.max_clients_per_ip and \
+                self.client_counts.get(peer, 0) >= self.max_clients_per_ip:
+            reason = 'too many clients from %s' % peer
+        else:
+            return False
+
+        logging.warning('%s rejected, %s', peer, reason)
+        self.metrics.inc('pycat_listener_rejected_total')
+        conn.close()
+        return True
+
+    def add_client(self, conn, peer):
+        client = Client(peer)
+        self.clients[conn] = client
+        self.client_counts[peer] = self.client_counts.get(peer, 0) + 1
+        self.readers.add(conn)
+
+        if self.backpressure:
+            self.paused[conn] = self.handle_reciver
+        else:
+            self.reactor.register(conn, self.handle_reciver)
+
+        self.schedule_client_timeout(conn, client)
+
+    def schedule_client_timeout(self, sock, client):
+        '''
+        Keep one timer per client for the earliest limit it could break.
+        Reading data does not move the timer, it is checked when it fires.
+        '''
+
+        deadlines = []
+        if self.client_idle:
+            deadlines.append(client.last + self.client_idle)
+        if self.client_deadline and client.partial is not None:
+            deadlines.append(client.partial + self.client_deadline)
+
+        if not deadlines:
+            return
+        elif client.timer and client.timer[0] <= min(deadlines):
+            return
+
+        self.reactor.cancel(client.timer)
+        client.timer = self.reactor.call_later(min(deadlines) - monotonic(),
+            self.handle_client_timeout, sock)
+
+    def close_client(self, sock, reason):
+        logging.warning('%s disconnected, %s', self.clients[sock].peer,
+            reason)
+        self.metrics.inc('pycat_listener_closed_total')
+
+        self.recv_buffers.pop(sock, None)
+        self.readers.discard(sock)
+        self.paused.pop(sock, None)
+        self.reactor.unregister(sock)
+        sock.close()
+
+        self.remove_client(sock)
+
+    def remove_client(self, sock):
+        client = self.clients.pop(sock)
+        self.reactor.cancel(client.timer)
+        self.uncount_client(client.peer)
+
+    def uncount_client(self, peer):
+        self.client_counts[peer] -= 1
+
+        if not self.client_counts[peer]:
+            del self.client_counts[peer]
+
+    def relay_line(self, line, peer):
+        logging.debug(u'%s %s', peer, Readable(line))
+        self.metrics.inc('pycat_received_lines_total', peer=peer)
+
+        targets, message = self.parse_targets(line)
+
+        if not message:
+            return
+
+        if not targets and self.networks:
+            network = self.networks.values()[0]
+            targets = {network: [network.channel]}
+
+        for network, names in targets.items():
+            logging.info("%s saying '%s' to %s on %s", peer, message,
+                u', '.join(names), network.name)
+            self.send(network, message, names, peer)
+
+    def peer_name(self, addr, sock):
+        '''Name to log a client by, unix clients are named by the socket'''
+
+        if isinstance(addr, tuple):
+            if addr[0].startswith('::ffff:'):
+                return addr[0][len('::ffff:'):]
+            return addr[0]
+
+        return addr or sock.getsockname() or 'unix'
+
+    def close_http(self, sock):
+        client = self.http_clients.pop(sock)
+        self.reactor.cancel(client.timer)
+        self.reactor.unregister(sock)
+        sock.close()
+        self.uncount_client(client.peer)
+
+    def send_http(self, sock, status, reply, keep_alive=True):
+        client = self.http_clients[sock]
+        body = json.dumps(reply) + '\n'
+
+        headers = ['HTTP/1.1 %d %s' % (status, self.HTTP_STATUS[status]),
+                   'Content-Type: application/json',
+                   'Content-Length: %d' % len(body)]
+
+        if status == 429:
+            headers.append('Retry-After: %d' % (self.drain_time() + 1))
+
+        if not keep_alive:
+            headers.append('Connection: close')
+            client.closing = True
+
+        self.metrics.inc('pycat_http_requests_total', code=str(status))
+
+        client.output += '\r\n'.join(headers) + '\r\n\r\n' + body
+        self.handle_http_writable(sock)
+
+    def http_request(self, method, body, peer):
+        '''Queue messages from a POSTed JSON body, returns status and reply'''
+
+        if method != 'POST':
+            return 405, {'error': 'only POST is supported'}
+        elif not self.connected() and not self.spool:
+            return 503, {'error': 'not connected to IRC'}
+        elif self.backpressure:
+            return 429, {'error': 'send queue is full',
+                         'queued': self.queued()}
+
+        try:
+            messages = json.loads(body)
+        except ValueError, e:
+            return 400, {'error': 'invalid JSON: %s' % e}
+
+        if isinstance(messages, dict):
+            messages = [messages]
+        elif not isinstance(messages, list):
+            return 400, {'error': 'expected a message or a list of them'}
+
+        accepted = 0
+
+        for message in messages:
+            if isinstance(message, dict) and self.ingest(message, peer):
+                accepted += 1
+
+        return 202, {'accepted': accepted,
+                     'rejected': len(messages) - accepted,
+                     'queued': self.queued()}
+
+    def ingest(self, message, peer):
+        '''Send a message given as a dict, returns False if it was invalid'''
+
+        text = message.get('message')
+        targets = message.get('targets', [])
+        prefix = self.MESSAGE_TYPES.get(message.get('type', 'privmsg'))
+
+        if not isinstance(text, basestring) or prefix is None or \
+                not isinstance(targets, list):
+            return False
+
+        # Same target syntax as the listener, bare names are taken as nicks
+        targets = [t if t[:1] in ('#', '@') else '@' + t
+                   for t in targets if isinstance(t, basestring) and t]
+
+        lines = []
+
+        # Check every line before sending any so the message is either
+        # accepted or rejected as a whole
+        for line in text.splitlines():
+            if not line:
+                continue
+            elif targets:
+                parsed, line = self.parse_targets(
+                    u'%s %s' % (','.join(targets), line))
+            else:
+                network = self.networks.values()[0]
+                parsed = {network: [network.channel]}
+
+            if not parsed:
+                return False
+
+            lines.append((parsed, line))
+
+        for parsed, line in lines:
+            for network, names in parsed.items():
+                logging.info("%s saying '%s' to %s on %s", peer, line,
+                    u', '.join(names), network.name)
+                self.send(network, prefix + line, names, peer)
+
+        return True
+
+    def connected(self):
+        if self.upstream:
+            return self.accepting
+
+        for network in self.networks.values():
+            if network.connection.is_connected():
+                return True
+        return False
+
+    def queued(self):
+        return sum(len(n.send_buffer) for n in self.networks.values())
+
+    def drain_time(self):
+        '''Seconds until every send queue is down to --queue-low'''
+
+        return max([(len(n.send_buffer) - self.queue_low) / n.send_bucket.rate
+            for n in self.networks.values()] + [0])
+
+    def pause_readers(self, network):
+        logging.warning('Send queue for %s has %d lines, pausing %d listener '
+            'clients', network.name, len(network.send_buffer),
+            len(self.readers))
+
+        self.pause_clients()
+        self.broadcast_ingest({'paused': True})
+
+    def pause_clients(self):
+        self.backpressure = True
+
+        for sock in self.readers:
+            self.paused[sock] = self.dispatchers[sock]
+            self.reactor.unregister(sock)
+
+    def check_backpressure(self):
+        '''Resume listener clients once every send queue is short enough'''
+
+        if not self.backpressure:
+            return
+
+        for network in self.networks.values():
+            if len(network.send_buffer) > self.queue_low:
+                return
+
+        self.resume_readers()
+
+    def resume_readers(self):
+        logging.info('Send queues down to %d lines, resuming listener clients '
+            '(%d lines dropped so far)', self.queued(),
+            sum(n.send_buffer.dropped for n in self.networks.values()))
+
+        self.resume_clients()
+        self.broadcast_ingest({'paused': False})
+
+    def resume_clients(self):
+        self.backpressure = False
+
+        for sock, handler in self.paused.items():
+            self.reactor.register(sock, handler)
+        self.paused.clear()
+
+    def reload_config(self):
+        config = {'routes': [], 'cache': 0}
+        handler = lambda s: self.handle_config(s, config)
+        return self.start_process(['--config'], handler, False)
+
+    def dump_state(self):
+        '''State for the process taking over and the fds it needs to keep'''
+
+        if self.spool:
+            self.spool.flush(True)
+
+        ingest = dict((worker.process.pid, worker) for worker in
+                      self.ingest_workers.values())
+
+        state = {'listeners': [], 'clients': [], 'networks': {},
+                 'unix_paths': self.unix_paths, 'http': None,
+                 'orphans': [(pid, child.name) for pid, child in
+                             self.supervisor.children.items()
+                             if pid not in ingest],
+                 'ingest': [(pid, worker.sock.fileno(),
+                             str(worker.framer.buffer).encode('base64'))
+                            for pid, worker in ingest.items()]}
+
+        for scheme, listener in self.listeners:
+            state['listeners'].append((scheme, listener.fileno(),
+                listener.family, listener.type))
+
+        for sock, client in self.clients.items():
+            framer = self.recv_buffers.get(sock)
+            buffered = framer and str(framer.buffer).encode('base64') or ''
+            state['clients'].append((sock.fileno(), sock.family, client.peer,
+                client.last, client.partial, client.received, buffered))
+
+        if self.http_listener:
+            state['http'] = self.http_listener.fileno()
+
+        for network in self.networks.values():
+            network_state = network.dump_state()
+            if network_state:
+                state['networks'][network.name] = network_state
+
+        fds = set(fd for scheme, fd, family, socktype in state['listeners'])
+        fds.update(client[0] for client in state['clients'])
+        fds.update(n['fd'] for n in state['networks'].values())
+        fds.update(fd for pid, fd, buffered in state['ingest'])
+        fds.add(state['http'])
+
+        return state, fds
+
+    def start_ingest(self):
+        '''Start ingest workers until there are --ingest-workers of them'''
+
+        if not self.listen_addrs:
+            return
+
+        for i in range(self.ingest_count - len(self.ingest_workers)):
+            ours, theirs = socket.socketpair(socket.AF_UNIX,
+                socket.SOCK_STREAM)
+
+            listeners = [(scheme, l.fileno(), l.family, l.type)
+                         for scheme, l in self.listeners]
+            fds = set([theirs.fileno()] + [l[1] for l in listeners])
+
+            env = dict(os.environ)
+            env[self.INGEST_ENV] = json.dumps({'upstream': theirs.fileno(),
+                'listeners': listeners})
+
+            def preexec():
+                os.setpgrp()
+                keep_on_exec(fds)
+
+            # Logs go straight to our stderr, the supervisor reaps them
+            started = self.supervisor.spawn([sys.executable] + sys.argv,
+                lambda process: self.add_ingest(process, ours), limited=False,
+                timeout=False, env=env, preexec_fn=preexec, close_fds=False,
+                stdout=None, stderr=None, name='ingest worker')
+            theirs.close()
+
+            if not started:
+                ours.close()
+                return
+
+        if self.ingest_workers and not self.snapshot_timer:
+            self.handle_snapshot()
+
+    def add_ingest(self, process, sock):
+        logging.info('Started ingest worker pid:%s', process.pid)
+
+        sock.setblocking(0)
+        worker = IngestWorker(process, sock, self.INGEST_MAX_LINE)
+        self.ingest_workers[sock] = worker
+        self.reactor.register(sock, self.handle_ingest)
+
+        if self.ingest_snapshot:
+            self.send_ingest(worker, self.ingest_snapshot)
+
+    def adopt_ingest(self):
+        '''Take over the ingest workers of the process we replaced'''
+
+        ingest = self.handover.get('ingest', [])
+        processes = self.supervisor.adopt([(pid, 'ingest worker')
+            for pid, fd, buffered in ingest], kill=False)
+
+        for process, (pid, fd, buffered) in zip(processes, ingest):
+            sock = self.adopt_socket(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+            self.add_ingest(process, sock)
+            if buffered:
+                self.ingest_workers[sock].framer.feed(
+                    buffered.decode('base64'))
+
+    def stop_ingest(self, worker):
+        del self.ingest_workers[worker.sock]
+        self.reactor.unregister(worker.sock)
+        self.reactor.unregister_writer(worker.sock)
+        worker.sock.close()
+
+        # Exits once it sees the socket close, or is made to
+        self.supervisor.terminate(worker.process)
+
+    def send_ingest(self, worker, line):
+        worker.output += line + '\n'
+        self.handle_ingest_writable(worker.sock)
+
+    def broadcast_ingest(self, update):
+        line = json.dumps(update)
+
+        for worker in self.ingest_workers.values():
+            self.send_ingest(worker, line)
+
+    def snapshot(self):
+        '''What ingest workers need to know to check targets themselves'''
+
+        networks = {}
+
+        for network in self.networks.values():
+            membership = network.membership
+            networks[network.name] = {
+                'channels': dict((channel, sorted(nicks)) for channel, nicks
+                                 in membership.channels.items()),
+                'casemapping': membership.casemapping,
+                'prefixes': membership.prefixes,
+                'limited': bool(self.spool) and
+                           network.name not in self.spool.cursors}
+
+        return {'networks': networks, 'paused': self.backpressure,
+                'accepting': self.connected() or bool(self.spool)}
+
+    def run_ingest(self):
+        '''Accept listener clients as an ingest worker until the relay exits'''
+
+        for name, network in self.networks.items():
+            self.networks[name] = IngestNetwork(network)
+
+        self.reactor.register(self.upstream, self.handle_upstream)
+        self.running = True
+
+        while self.running:
+            self.reactor.run_once()
+
+    def forward(self, network, message, targets, source):
+        '''Pass a message on to the relay, batched until the next loop'''
+
+        self.upstream_output.append(json.dumps([network.name, targets,
+            message, source]))
+
+        if not self.upstream_timer:
+            self.upstream_timer = self.reactor.call_later(0,
+                self.flush_upstream)
+
+    def flush_upstream(self):
+        self.upstream_timer = None
+
+        if not self.upstream_output:
+            return
+
+        data = '\n'.join(self.upstream_output) + '\n'
+        del self.upstream_output[:]
+
+        try:
+            # Blocking, a busy relay slows down reading from our clients
+            self.upstream.sendall(data)
+        except socket.error, e:
+            logging.error('Could not send to relay: %s', e)
+            self.running = False
+
+    def start_workers(self):
+        if not self.script:
+            return
+
+        # Retired workers are still finishing their last request
+        active = [w for w in self.workers if not w.process.stdin.closed]
+
+        for i in range(self.worker_count - len(active)):
+            args = map(encode, self.script + ['--coprocess'])
+
+            if not self.supervisor.spawn(args, self.add_worker, limited=False,
+                    timeout=False, stdin=subprocess.PIPE):
+                return
+
+        self.dispatch_requests()
+
+    def add_worker(self, process):
+        logging.info('Started %s pid:%s', self.script[0], process.pid)
+
+        worker = Worker(process)
+        self.workers.append(worker)
+
+        self.reactor.register(process.stdout,
+            lambda s: self.handle_worker(s, worker))
+        self.reactor.register(process.stderr, self.handle_stderr)
+
+    def retire_workers(self):
+        '''Let workers finish their current request and exit'''
+
+        for worker in self.workers:
+            if not worker.process.stdin.closed:
+                worker.process.stdin.close()
+
+    def stop_workers(self):
+        self.retire_workers()
+        del self.workers[:]
+
+    def run_script(self, network, nick, target, source, message):
+        if not self.script and not self.router.routes:
+            return
+
+        script = self.router.route(message, nick)
+
+        if not script:
+            return
+
+        if self.nick_limiter and \
+                not self.nick_limiter.allow((network.name, source)):
+            logging.warning('Ignoring %s, too many commands', source)
+            return
+
+        if self.channel_limiter and \
+                not self.channel_limiter.allow((network.name, target)):
+            logging.warning('Ignoring %s in %s, too many commands', source,
+                target)
+            return
+
+        key = self.cache_key(script, target, message)
+
+        if key in self.cache.pending:
+            logging.debug('Waiting for running %s to answer: %s', script[0],
+                message)
+            self.cache.pending[key][1].append((network, target, source))
+            return
+        elif key:
+            lines = self.cache.get(key)
+
+            if lines is not None:
+                logging.debug('Answering from cache: %s', message)
+                for line in lines:
+                    self.send_reply(network, line, target, source, script[0])
+                return
+
+            self.cache.pending[key] = ([], [])
+
+        if script is self.script and self.worker_count:
+            self.queue_request(network, nick, target, source, message, key)
+        elif not self.start_process([nick, target, source, message],
+                lambda s: self.handle_stdout(s, network, target, source,
+                    script[0], key),
+                script=script):
+            if key:
+                self.finish_cached(key, store=False)
+
+    def cache_key(self, script, target, message):
+        '''
+        Key for caching the reply to message, None when caching is off. Only
+        the main script opts in to caching, and it is asked again whenever it
+        changes, so its signature is part of the key.
+        '''
+
+        if not self.cache.ttl or script is not self.script:
+            return None
+
+        signature = self.watcher and self.watcher.signature
+        return (signature, is_channel(target), u' '.join(message.split()))
+
+    def finish_cached(self, key, name=None, store=True):
+        '''Pass the reply to a cacheable command on to whoever waited for it'''
+
+        lines, waiters = self.cache.pending.pop(key)
+
+        if store:
+            self.cache.put(key, lines)
+
+        for network, target, source in waiters:
+            for line in lines:
+                self.send_reply(network, line, target, source, name)
+
+    def queue_request(self, network, nick, target, source, message, key=None):
+        if len(self.requests) >= self.script_queue:
+            logging.warning('Too many requests waiting for %s, dropping: %s',
+                self.script[0], message)
+            if key:
+                self.finish_cached(key, store=False)
+            return
+
+        self.request_id += 1
+
+        request = {'id': self.request_id, 'nick': nick, 'target': target,
+                   'source': source, 'message': message,
+                   'network': network.name}
+        self.requests.append((self.request_id, request, network, target,
+            source, key))
+
+        self.dispatch_requests()
+
+    def dispatch_requests(self):
+        for worker in self.workers:
+            if not self.requests:
+                break
+            elif worker.request or worker.process.stdin.closed:
+                continue
+
+            worker.request = self.requests.popleft()
+
+            try:
+                os.write(worker.process.stdin.fileno(),
+                    json.dumps(worker.request[1]) + '\n')
+            except OSError, e:
+                logging.error('Could not send request to %s pid:%s: %s',
+                    self.script[0], worker.process.pid, e)
+                continue # Worker exit handler will clean up
+
+            worker.timer = self.reactor.call_later(self.supervisor.timeout,
+                self.handle_worker_timeout, worker)
+
+    def finish_request(self, worker):
+        self.reactor.cancel(worker.timer)
+        worker.timer = None
+        worker.request = None
+
+        self.dispatch_requests()
+
+    def send(self, network, message, targets, source=None):
+        '''Send an accepted message unless it repeats a recent one'''
+
+        if self.upstream:
+            self.forward(network, message, targets, source)
+            return
+        elif self.dedup and \
+                not self.dedup.admit(network, message, targets, source):
+            logging.debug(u"Holding back repeat of '%s'", Readable(message))
+            return
+
+        self.deliver(network, message, targets, source)
+
+    def deliver(self, network, message, targets, source=None):
+        '''Send a message, going through the spool if we have one'''
+
+        if not self.spool:
+            network.send_message(message, targets, source)
+            return
+
+        spool_id, current = self.spool.append(network.name, targets, message,
+            source)
+
+        if current:
+            network.send_message(message, targets, source, spool_id)
+        else:
+            network.replay_spool()
+
+    def send_reply(self, network, line, target, source, name=None):
+        if is_channel(target):
+            default = target
+        else:
+            default = source
 
-def decode(string):
-    '''Force strings into unicode string objects'''
+        targets, message = self.parse_targets(line, network)
+        targets = targets or {network: [default]}
 
-    if isinstance(string, unicode) or string is None:
-        return string
+        for network, names in targets.items():
+            logging.info(u"%s saying '%s' to %s on %s", name or self.script[0],
+                Readable(message), ', '.join(names), network.name)
+            network.send_message(message, names, source)
 
-    try:
-        string = string.decode('utf-8')
-    except UnicodeDecodeError:
-        string = string.decode('iso-8859-1')
-    return string
+    def read_pipe(self, pipe):
+        '''Read what is available without waiting for the pipe to fill'''
 
-def encode(string):
-    '''Encode (unicode) strings as utf-8'''
+        try:
+            return os.read(pipe.fileno(), self.recv_size)
+        except OSError, e:
+            logging.error('Could not read from pipe: %s', e)
+            return ''
 
-    if isinstance(string, unicode):
-        return string.encode('utf-8')
+    def start_process(self, args, handler, limited=True, script=None):
+        args = list((script or self.script) + args)
+        name = args[0]
 
-    return string
+        logging.debug('Starting: %s', ' '.join(args))
+        args = map(encode, args)
 
-def readable(string):
-    '''Convert a string to readable format for logging'''
+        def started(process):
+            self.reactor.register(process.stdout, handler)
+            self.reactor.register(process.stderr,
+                lambda s: self.handle_stderr(s, name))
 
-    new_string = ''
+        return self.supervisor.spawn(args, started, limited)
 
-    for s in string:
-        if len(s) == 1 and ord(s) < 32:
-            new_string += r'\x%02X' % ord(s)
-        else:
-            new_string += s
+    def process_data(self, sock, data):
+        if sock not in self.recv_buffers:
+            self.recv_buffers[sock] = LineFramer(self.max_line)
 
-    return new_string
+        for line in self.recv_buffers[sock].feed(data):
+            yield line
 
-def strip_unprintable(string):
-    '''
-    Removes standard unprintable sequences from the text.
-    Regexes retrived from AnyEvent::IRC::Util on CPAN
-    '''
+        if len(data) == 0:
+            line = self.recv_buffers[sock].flush()
+
+            del self.recv_buffers[sock]
+            self.readers.discard(sock)
+            self.reactor.unregister(sock)
+            sock.close()
 
-    regexes = ('\x1B\[.*?[\x00-\x1F\x40-\x7E]', # ECMA-48
-               '\x03\d\d?(?:,\d\d?)?', # IRC colors
-               '[\x03\x16\x02\x1f\x0f]') # Other unprintables
+            if line:
+                yield line
 
-    return re.sub('|'.join(regexes), '', string)
+    def parse_targets(self, line, default=None):
+        '''
+        Split leading #channel and @nick targets off line, grouped by the
+        network they are on. Targets without an @network suffix belong to
+        default or the first network, targets we are not allowed to send
+        to are left out.
+        '''
 
-def dequote(string):
+        if default is None and self.networks:
+            default = self.networks.values()[0]
+
+        targets = {}
+        parts = line.split(' ')
+
+        if '@' in parts[0] or '#' in parts[0]:
+            for target in parts.pop(0).split(','):
+                if target[:1] not in ('#', '@'):
+                    continue
+
+                network = default
+                if '@' in target[1:]:
+                    name = target[1:].rsplit('@', 1)[1]
+                    if name in self.networks:
+                        network = self.networks[name]
+                        target = target[:-len(name) - 1]
+
+                target = target.lstrip('@')
+
+                if network and network.allowed(target):
+                    targets.setdefault(network, []).append(target)
+
+        return targets, ' '.join(parts)
+
+class PyCat(SingleServerIRCBot):
     '''
-    Removes matching single or double quotes.
+    Connection to a single IRC network and the channels joined there, each
+    with its own throttled send queue. Listeners and scripts live in the
+    relay shared by all networks.
     '''
 
-    if (string[0] == string[-1]) and string.startswith(("'", '"')):
-        return string[1:-1]
-    return string
+    # Seconds after the welcome to start replaying the spool even if some of
+    # our channels could not be joined
+    REPLAY_DELAY = 10
 
-class PyCat(SingleServerIRCBot):
-    def __init__(self, server_list, nick, real, channel,
-                 listen_addr=None, script=None, deop=True, opfirst=True):
+    # Servers are probed PROBE_DELAY seconds apart, with at most MAX_PROBES
+    # connects in progress, until one answers. Failed rounds are retried
+    # after RECONNECT_MIN seconds, doubling up to --reconnect-max.
+    PROBE_DELAY = 0.25
+    MAX_PROBES = 3
+    CONNECT_TIMEOUT = 10
+    REGISTER_TIMEOUT = 30
+    RECONNECT_MIN = 1
+
+    def __init__(self, relay, name, server_list, nick, real, channels,
+                 deop=True, opfirst=True, rate=0.5, burst=5, coalesce=None,
+                 queue_limit=1000, queue_policy='block', reconnect_max=60):
 
         SingleServerIRCBot.__init__(self, server_list, nick, real,
                                     reconnection_interval=30)
 
-        self.channel = decode(channel)
-        self.script = map(decode, script or [])
-        self.listen_addr = listen_addr
+        self.relay = relay
+        self.name = name
+        self.channel_names = map(decode, channels)
+        self.channel = self.channel_names[0]
         self.deop = deop
         self.opfirst = opfirst
 
-        self.match = '^!'
-        self.match_timer = 0
-        self.script_modified = 0
-
-        self.dispatchers = {}
+        self.reactor = relay.reactor
+        self.metrics = relay.metrics
+        self.tracer = relay.tracer
         self.irc_socket = None
+        self.irc_timer = None
+
+        self.servers = [Server(*entry) for entry in server_list]
+        self.server = None
+        self.probes = {}
+        self.probe_queue = []
+        self.probe_timer = None
+        self.lookups = set()
+        self.lookup_round = 0
+        self.connect_timer = None
+        self.connect_started = None
+        self.register_timer = None
+        self.reconnect_timer = None
+        self.reconnect_max = reconnect_max
+        self.attempts = 0
+        self.registered = False
+        self.stopping = False
 
         self.target_nick = nick
 
-        self.send_timer = 0
-        self.send_buffer = []
-        self.recv_buffers = {}
+        self.send_bucket = TokenBucket(rate, burst)
+        self.send_source = None
+        self.send_spool_id = None
+        self.send_event = None
+        self.send_buffer = SendQueue(coalesce, self.max_line_length(nick),
+            limit=queue_limit, policy=queue_policy)
+
+        self.membership = Membership()
+
+        # Queued lines per spooled message, acknowledged when all are sent
+        self.spool_lines = {}
 
         self.setup_logging()
         self.setup_throttling()
-        self.setup_listener()
-
-        self.running = False
 
     ## Init helpers ##
-    def setup_listener(self):
-        if not self.listen_addr:
-            logging.debug('No listener, stopping listener setup')
-            return
-
-        try:
-            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            listener.setblocking(0)
-            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            listener.bind(self.listen_addr)
-            listener.listen(5)
-        except socket.gaierror, e:
-            logging.error('Could not setup listener: %s', e)
-            return
-
-        logging.info('Listener set up on %s:%s' % self.listen_addr)
-        self.dispatchers[listener] = self.handle_listener
-
     def setup_logging(self):
         def debug_logger(conn, event):
-            line = decode(event.arguments()[0])
-            logging.debug(readable(line))
+            logging.debug(u'%s', Readable(event.arguments()[0]))
         self.connection.add_global_handler('all_raw_messages', debug_logger)
 
     def setup_throttling(self):
         self.send_raw = self.connection.send_raw
-        self.connection.send_raw = self.send_buffer.append
+        self.connection.send_raw = self.queue_raw
+
+        # Let irclib's delayed commands share our timer heap
+        self.ircobj.fn_to_add_timeout = self.schedule_irc_timeout
 
     def remove_throttling(self):
         self.connection.send_raw = self.send_raw
 
-    ## Event loop and cleanup code ##
+    ## Connection start and cleanup code ##
     def start(self):
-        if not self._connect():
-            self._connected_checker()
-
-        self.running = True
-
-        while self.running:
-            sockets = self.dispatchers.keys()
-
-            for sock in select.select(sockets, [], [], 0.2)[0]:
-                self.dispatchers[sock](sock)
+        handover = self.relay.handover
 
-            self.handle_timeout()
+        if handover and self.name in handover['networks']:
+            self.restore(handover['networks'][self.name])
+        else:
+            self.connect_servers()
 
     def stop(self):
+        self.stopping = True
+        self.stop_probes()
+        self.reactor.cancel(self.reconnect_timer)
         self.remove_throttling()
 
         if self.connection.is_connected():
             self.connection.disconnect('...')
 
-        for sock in self.dispatchers.keys():
-            sock.close()
-            del self.dispatchers[sock]
-
     ## CTCP version reply ##
     def get_version():
         return VERSION
@@ -188,216 +4307,492 @@ class PyCat(SingleServerIRCBot):
     def handle_irc(self, sock):
         self.ircobj.process_data([sock])
 
-    def handle_timeout(self):
-        self.handle_send_buffer()
-        self.handle_check_config()
+    def handle_irc_timeout(self):
+        self.irc_timer = None
         self.ircobj.process_timeout()
+        self.schedule_irc_timeout()
 
     def handle_send_buffer(self):
-        if not self.send_buffer:
+        self.send_event = None
+
+        while self.send_buffer and self.send_bucket.consume():
+            string, queued, ids = self.send_buffer.pop()
+            logging.debug(u'%s', Readable(string))
+            self.send_raw(string)
+            self.release_spooled(ids)
+
+            self.metrics.inc('pycat_sent_lines_total', network=self.name)
+            self.metrics.inc('pycat_sent_bytes_total', len(string) + 2,
+                network=self.name)
+            self.metrics.observe('pycat_send_latency_seconds',
+                monotonic() - queued, network=self.name)
+
+            if self.tracer and self.tracer.sampled():
+                self.tracer.event('send', fd=self.reactor.filenos.get(
+                    self.irc_socket), bytes=len(string) + 2,
+                    queue=len(self.send_buffer), latency=monotonic() - queued,
+                    network=self.name)
+
+        if len(self.send_buffer) <= self.relay.queue_low:
+            self.relay.check_backpressure()
+            self.replay_spool()
+
+        if self.send_buffer and not self.send_event:
+            self.send_event = self.reactor.call_later(
+                self.send_bucket.delay(), self.handle_send_buffer)
+
+    # Connect handlers
+    def handle_probe(self, sock):
+        server, started = self.probes.pop(sock)
+        self.reactor.unregister(sock)
+
+        error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+        if error:
+            logging.error('Failed to connect to %s: %s', server,
+                os.strerror(error))
+            self.metrics.inc('pycat_connect_failures_total',
+                network=self.name)
+            server.failed()
+            sock.close()
+
+            # Don't wait for the next probe to be due
+            self.reactor.cancel(self.probe_timer)
+            self.start_probe()
             return
 
-        if self.send_timer < time.time():
-            self.send_timer = time.time()
+        self.stop_probes()
+        self.attach(sock, server, started)
 
-        while self.send_timer < time.time() + 10 and self.send_buffer:
-            self.send_timer += 2
+    def handle_connect_timeout(self):
+        self.connect_timer = None
 
-            string = self.send_buffer.pop(0)
-            logging.debug(readable(decode(string)))
-            self.send_raw(string)
+        for server, started in self.probes.values():
+            logging.error('Timed out connecting to %s', server)
+            self.metrics.inc('pycat_connect_failures_total',
+                network=self.name)
+            server.failed()
 
-    # Listener handlers
-    def handle_listener(self, sock):
-        conn, addr = sock.accept()
-        logging.debug('%s connected', addr[0])
+        for server in self.lookups:
+            logging.error('Timed out resolving %s', server)
+            server.failed()
 
-        if self.connection.is_connected():
-            self.dispatchers[conn] = lambda s: self.handle_reciver(s, addr[0])
-        else:
-            logging.warning('%s disconnected as irc is down', addr[0])
-            conn.close()
+        self.stop_probes()
+        self.connect_failed()
 
-    def handle_reciver(self, sock, peer):
-        try:
-            data = sock.recv(4096)
-        except socket.error, e:
-            data = ''
-            logging.error('%s %s', peer, e)
+    def handle_resolved(self, result, rank, server, round):
+        '''Queue the addresses of server in order of preference and probe'''
 
-        for line in self.process_data(sock, data):
-            logging.debug('%s %s', peer, readable(line))
+        if round != self.lookup_round or server not in self.lookups:
+            return
 
-            targets, message = self.parse_targets(line)
-            targets = targets or [self.channel]
+        self.lookups.discard(server)
 
-            if not message:
-                continue
+        if isinstance(result, socket.error):
+            logging.error('Could not resolve %s: %s', server, result)
+            server.failed()
+            result = []
 
-            logging.info("%s saying '%s' to %s", peer, message,
-                u', '.join(targets))
-            self.send_message(message, targets)
+        for index, (family, socktype, proto, name, address) in \
+                enumerate(result):
+            bisect.insort(self.probe_queue,
+                ((rank, index), server, family, address))
 
-        if len(data) == 0:
-            logging.debug('%s disconnected', peer)
+        if not self.probe_timer and len(self.probes) < self.MAX_PROBES:
+            self.start_probe()
 
-    # Process handlers
-    def handle_stdout(self, sock, target, source):
-        data = sock.read(4096)
+    def handle_register_timeout(self):
+        self.register_timer = None
+        logging.error('%s did not welcome us in time', self.server)
+        self.connection.disconnect('Registration timed out')
 
-        if target == self.channel:
-            default = self.channel
-        else:
-            default = source
+    ## Event loop helper methods ##
+    def queue_raw(self, string):
+        ids = ()
 
-        for line in self.process_data(sock, data):
-            targets, message = self.parse_targets(line)
-            targets = targets or [default]
+        if self.send_spool_id is not None:
+            ids = (self.send_spool_id,)
+            self.spool_lines[self.send_spool_id] = \
+                self.spool_lines.get(self.send_spool_id, 0) + 1
 
-            logging.info("%s saying '%s' to %s", self.script[0],
-                readable(message), ', '.join(targets))
-            self.send_message(message, targets)
+        self.send_buffer.append(string, self.send_source, ids)
+        self.release_spooled(self.send_buffer.discarded)
+        del self.send_buffer.discarded[:]
 
-    def handle_stderr(self, sock):
-        data = sock.read(4096)
+        self.metrics.inc('pycat_queued_lines_total', network=self.name,
+            source=self.send_source or 'pycat')
 
-        for line in self.process_data(sock, data):
-            logging.error('%s %s', self.script[0], line)
+        if len(self.send_buffer) >= self.relay.queue_high and \
+                not self.relay.backpressure:
+            self.relay.pause_readers(self)
+
+        if not self.send_event:
+            self.send_event = self.reactor.call_later(
+                self.send_bucket.delay(), self.handle_send_buffer)
+
+    def release_spooled(self, ids):
+        '''Acknowledge spooled messages once none of their lines are queued'''
+
+        for spool_id in ids:
+            self.spool_lines[spool_id] -= 1
+
+            if not self.spool_lines[spool_id]:
+                del self.spool_lines[spool_id]
+                self.relay.spool.ack(spool_id)
 
-    def handle_check_config(self):
-        if not self.script or self.match_timer > time.time():
+    def start_spool(self):
+        '''Start replaying what was spooled while we were away'''
+
+        spool = self.relay.spool
+
+        if not spool or self.name in spool.cursors or \
+                not self.connection.is_connected():
             return
 
-        self.match_timer = time.time() + 5
+        logging.info('Replaying spooled messages on %s', self.name)
+        spool.start(self.name)
+        self.replay_spool()
 
-        try:
-            last_modified = os.stat(self.script[0]).st_mtime
-        except OSError, e:
-            logging.debug('Could not stat %s: %s', self.script[0], e)
+    def replay_spool(self):
+        '''Queue spooled messages while the send queue is short'''
+
+        if not self.relay.spool:
             return
 
-        if self.script_modified == last_modified:
+        count = self.relay.queue_low - len(self.send_buffer)
+
+        for record in self.relay.spool.replay(self.name, count):
+            self.send_message(record['message'], record['targets'],
+                record['source'], record['id'])
+
+    def connect_servers(self):
+        '''Connect to the servers, best first, and use whichever answers'''
+
+        if self.probes or self.lookups or self.connection.is_connected() or \
+                self.stopping:
             return
 
-        time_since_change = time.time() - last_modified
+        self.reactor.cancel(self.reconnect_timer)
+        self.reconnect_timer = None
 
-        if time_since_change < 2:
-            time.sleep(2 - time_since_change)
+        # Lookups still running from an earlier round are ignored
+        self.lookup_round += 1
+        self.connect_timer = self.reactor.call_later(self.CONNECT_TIMEOUT,
+            self.handle_connect_timeout)
 
-        if self.start_process(['--config'], self.handle_config):
-            self.script_modified = last_modified
+        # Stable sort, so the list order decides between equal servers
+        for rank, server in enumerate(sorted(self.servers,
+                                             key=Server.preference)):
+            self.lookups.add(server)
+            self.relay.resolver.resolve(server.host, server.port,
+                self.handle_resolved, rank, server, self.lookup_round)
 
-    def handle_config(self, sock):
-        data = sock.read(4096)
+    def start_probe(self):
+        '''Start a non-blocking connect to the next server in line'''
 
-        for line in self.process_data(sock, data):
-            # XXX use shlex or other suitable scheme to parse this with respect
-            #     to leading and trailing whitespace and "' handling
-            match = re.match('^(?P<key>\w+)\s*=\s*(?P<value>.+)', line)
+        self.probe_timer = None
 
-            if not match:
-                logging.error("Invalid reply from %s: '%s'", self.script[0], line)
-                continue
+        while self.probe_queue:
+            rank, server, family, address = self.probe_queue.pop(0)
 
-            key, value = match.groups()
+            logging.info('Trying to connect to %s', server)
+            self.metrics.inc('pycat_connects_total', network=self.name)
 
-            if key == 'match': # If this grows a dispatcher table may be better
-                self.match = value
-                logging.info("Setting match regexp to '%s'", value)
-            else:
-                logging.warning("Unknown config key: %s = '%s'", key, value)
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.setblocking(0)
+            error = sock.connect_ex(address)
 
-    def handle_hanging_process(self, process):
-        if process.poll() is None:
-            logging.error('%s pid:%s taking to long, sending SIGTERM',
-                self.script[0], process.pid)
-            os.kill(process.pid, signal.SIGTERM)
+            if error in (0, errno.EINPROGRESS):
+                self.probes[sock] = (server, monotonic())
+                self.reactor.register(sock, self.handle_probe)
+                self.reactor.register_writer(sock, self.handle_probe)
+                break
 
-    ## Event loop helper methods ##
-    def start_process(self, args, handler):
-        args = list(self.script + args)
+            logging.error('Failed to connect to %s: %s', server,
+                os.strerror(error))
+            self.metrics.inc('pycat_connect_failures_total',
+                network=self.name)
+            server.failed()
+            sock.close()
 
-        logging.debug('Starting: %s', ' '.join(args))
-        args = map(encode, args)
+        if self.probe_queue and len(self.probes) < self.MAX_PROBES:
+            self.probe_timer = self.reactor.call_later(self.PROBE_DELAY,
+                self.start_probe)
+        elif not self.probes and not self.lookups and self.connect_timer:
+            self.stop_probes()
+            self.connect_failed()
 
-        try:
-            process = subprocess.Popen(args, bufsize=4096,
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        except OSError, e:
-            logging.error('Could not start process: %s', e)
-            return False
+    def stop_probes(self):
+        for sock in self.probes:
+            self.reactor.unregister(sock)
+            sock.close()
 
-        self.dispatchers[process.stdout] = handler
-        self.dispatchers[process.stderr] = self.handle_stderr
+        self.probes.clear()
+        self.lookups.clear()
+        del self.probe_queue[:]
 
-        self.connection.execute_delayed(30, self.handle_hanging_process, [process])
+        self.reactor.cancel(self.probe_timer)
+        self.reactor.cancel(self.connect_timer)
+        self.probe_timer = self.connect_timer = None
 
-        return True
+    def connect_failed(self):
+        self.attempts += 1
+        self.schedule_reconnect()
 
-    def process_data(self, sock, data):
-        if sock not in self.recv_buffers:
-            self.recv_buffers[sock] = u''
+    def schedule_reconnect(self):
+        '''Try again right away the first time, then back off with jitter'''
 
-        self.recv_buffers[sock] += decode(data)
+        if self.stopping or self.reconnect_timer:
+            return
 
-        while '\n' in self.recv_buffers[sock]:
-            line, trailing = self.recv_buffers[sock].split('\n', 1)
-            self.recv_buffers[sock] = trailing
+        if self.attempts:
+            delay = min(self.reconnect_max,
+                self.RECONNECT_MIN * 2 ** min(self.attempts - 1, 16))
+            delay = random.uniform(delay / 2.0, delay)
+        else:
+            delay = 0
+
+        logging.info('Reconnecting to %s in %.1f seconds', self.name, delay)
+        self.reconnect_timer = self.reactor.call_later(delay,
+            self.connect_servers)
+
+    def attach(self, sock, server, started, login=True):
+        '''
+        Log on over a socket we connected ourselves, setting up irclib's
+        connection the way ServerConnection.connect would have.
+        '''
+
+        logging.info('Connected to %s', server)
+        sock.setblocking(1)
+
+        conn = self.connection
+        conn.previous_buffer = ''
+        conn.handlers = {}
+        conn.real_server_name = ''
+        conn.real_nickname = self._nickname
+        conn.server = server.host
+        conn.port = server.port
+        conn.nickname = self._nickname
+        conn.username = self._nickname
+        conn.ircname = self._realname
+        conn.password = server.password
+        conn.localaddress = ''
+        conn.localport = 0
+        conn.localhost = socket.gethostname()
+        conn.ssl = None
+        conn.socket = sock
+        conn.connected = 1
+
+        self.server = server
+        self.irc_socket = sock
+        self.reactor.register(self.irc_socket, self.handle_irc)
 
-            if line:
-                yield line
+        # Use TCP keepalive, see 'man tcp' for details about values:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, True)
+        sock.setsockopt(socket.SOL_TCP, socket.TCP_KEEPIDLE, 150)
+        sock.setsockopt(socket.SOL_TCP, socket.TCP_KEEPINTVL, 30)
+        sock.setsockopt(socket.SOL_TCP, socket.TCP_KEEPCNT, 5)
 
-        if len(data) == 0:
-            line = self.recv_buffers[sock]
+        if not login:
+            return
 
-            del self.recv_buffers[sock]
-            del self.dispatchers[sock]
-            sock.close()
+        self.connect_started = started
+        self.register_timer = self.reactor.call_later(self.REGISTER_TIMEOUT,
+            self.handle_register_timeout)
+
+        if server.password:
+            conn.pass_(server.password)
+        conn.nick(conn.nickname)
+        conn.user(conn.username, conn.ircname)
+
+    def dump_state(self):
+        '''What restore() needs to carry on with this connection'''
+
+        if not self.registered or not self.connection.is_connected():
+            return None
+
+        conn = self.connection
+        spool = self.relay.spool
+        cursor = spool and spool.cursors.get(self.name)
+
+        channels = {}
+        for name, channel in self.channels.items():
+            channels[decode(name)] = [map(decode, d.keys()) for d in
+                (channel.userdict, channel.operdict, channel.voiceddict)] + \
+                [channel.modes]
+
+        return {'fd': self.irc_socket.fileno(),
+                'family': self.irc_socket.family,
+                'server': (self.server.host, self.server.port),
+                'servers': [(s.health, s.latency) for s in self.servers],
+                'nickname': decode(conn.real_nickname),
+                'server_name': decode(conn.real_server_name),
+                'buffer': conn.previous_buffer.encode('base64'),
+                'channels': channels,
+                'membership': dict((channel, list(nicks)) for channel, nicks
+                                   in self.membership.channels.items()),
+                'casemapping': self.membership.casemapping,
+                'prefixes': self.membership.prefixes,
+                'max_length': self.send_buffer.max_length,
+                'queue': self.send_buffer.dump(),
+                'bucket': (self.send_bucket.tokens, self.send_bucket.stamp),
+                'spool_lines': self.spool_lines.items(),
+                'spool': cursor and cursor + (cursor == (spool.active,
+                                                         spool.size),)}
+
+    def restore(self, state):
+        '''Carry on with a connection handed over by the previous process'''
+
+        sock = socket.fromfd(state['fd'], state['family'], socket.SOCK_STREAM)
+        os.close(state['fd'])
+
+        for server, (health, latency) in zip(self.servers, state['servers']):
+            server.health, server.latency = health, latency
+
+        host, port = state['server']
+        found = [s for s in self.servers if (s.host, s.port) == (host, port)]
+
+        self.attach(sock, found and found[0] or Server(host, port), None,
+            False)
+        self.registered = True
+
+        conn = self.connection
+        conn.real_nickname = conn.nickname = encode(state['nickname'])
+        conn.real_server_name = encode(state['server_name'])
+        conn.previous_buffer = state['buffer'].decode('base64')
+
+        for name, (users, opers, voiced, modes) in state['channels'].items():
+            channel = self.channels[encode(name)] = Channel()
+            for nicks, known in ((users, channel.userdict),
+                                 (opers, channel.operdict),
+                                 (voiced, channel.voiceddict)):
+                for nick in nicks:
+                    known[encode(nick)] = 1
+            channel.modes = dict((encode(mode), encode(value))
+                                 for mode, value in modes.items())
+
+        self.membership.set_casemapping(state['casemapping'])
+        self.membership.prefixes = state['prefixes']
+        self.membership.channels = dict((channel, set(nicks)) for channel,
+            nicks in state['membership'].items())
+
+        self.send_buffer.max_length = state['max_length']
+        self.send_buffer.load(*state['queue'])
+        self.send_bucket.tokens, self.send_bucket.stamp = state['bucket']
+        self.spool_lines = dict(state['spool_lines'])
+
+        spool = self.relay.spool
+
+        if spool and state['spool']:
+            segment, offset, current = state['spool']
+            if current:
+                spool.cursors[self.name] = (spool.active, spool.size)
+            elif segment in spool.segments:
+                spool.cursors[self.name] = (segment, offset)
+            else:
+                spool.start(self.name)
+        elif spool:
+            self.reactor.call_later(self.REPLAY_DELAY, self.start_spool)
 
-            if line:
-                yield line
+        logging.info('Took over connection to %s as %s with %d lines queued',
+            self.server, state['nickname'], len(self.send_buffer))
 
-    def parse_targets(self, line):
-        if encode(self.channel) not in self.channels:
-            return [], line
+        if self.send_buffer:
+            self.send_event = self.reactor.call_later(
+                self.send_bucket.delay(), self.handle_send_buffer)
 
-        allowed_targets = self.channels[encode(self.channel)].users()
-        allowed_targets = map(decode, allowed_targets)
-        allowed_targets.append(self.channel)
+    def schedule_irc_timeout(self, delay=None):
+        self.reactor.cancel(self.irc_timer)
+        self.irc_timer = None
 
-        targets = []
-        parts = line.split(' ')
+        if self.ircobj.delayed_commands:
+            when = self.ircobj.delayed_commands[0][0] - time.time()
+            self.irc_timer = self.reactor.call_later(when,
+                self.handle_irc_timeout)
 
-        if '@' in parts[0] or '#' in parts[0]:
-            valid = lambda s: s[0] in '#@'
-            strip = lambda s: s.lstrip('@')
-            allowed = lambda s: s in allowed_targets
+    def max_line_length(self, mask):
+        '''
+        Longest line we can send that still fits in 512 bytes once the
+        server has prefixed it with ':nick!user@host ' and added CRLF.
+        '''
 
-            targets = parts.pop(0).split(',')
-            targets = filter(valid, targets)
-            targets = map(strip, targets)
-            targets = filter(allowed, targets)
+        if '!' not in mask:
+            mask += '!%s@%s' % ('x' * 10, 'x' * 63) # Worst case user@host
 
-        return targets, ' '.join(parts)
+        return 512 - len(':%s \r\n' % mask)
 
-    def send_message(self, message, targets):
-        encoded_targets = map(encode, targets)
+    def is_ours(self, channel):
+        '''Check if channel is one of the channels we were told to join'''
+
+        return self.membership.matches(self.channel_names, channel)
+
+    def allowed(self, target):
+        '''Only send to our channels and nicks that are in one of them'''
+
+        spool = self.relay.spool
+
+        if spool and self.name not in spool.cursors:
+            # Not knowing who is around yet, spool for our channels only
+            return self.is_ours(target)
+
+        return self.membership.reaches(self.channel_names, target)
+
+    def send_message(self, message, targets, source=None, spool_id=None):
+        if not self.connection.is_connected():
+            logging.warning('Not connected to %s, dropping: %s', self.name,
+                message)
+            return
+
+        encoded_targets = encode_lines(targets)
         encoded_message = encode(message)
 
+        # Split what does not fit in a line once the server has added its
+        # prefix, with room for the command and targets
+        length = self.send_buffer.max_length
+
+        # Lets queue_raw know whose fair share these lines count against
+        # and which spooled message they belong to
+        self.send_source = source
+        self.send_spool_id = spool_id
+
         if message.startswith('/me '):
+            text = encoded_message[len('/me '):]
             for target in encoded_targets:
-                self.connection.action(target, encoded_message[len('/me '):])
+                prefix = 'PRIVMSG %s :\x01ACTION \x01' % target
+                for part in split_utf8(text, length - len(prefix)):
+                    self.connection.action(target, part)
         elif message.startswith('/notice '):
+            text = encoded_message[len('/notice '):]
             for target in encoded_targets:
-                self.connection.notice(target, encoded_message[len('/notice '):])
+                prefix = 'NOTICE %s :' % target
+                for part in split_utf8(text, length - len(prefix)):
+                    self.connection.notice(target, part)
         else:
-            self.connection.privmsg_many(map(encode, targets), encoded_message)
+            prefix = 'PRIVMSG %s :' % ','.join(encoded_targets)
+            for part in split_utf8(encoded_message, length - len(prefix)):
+                self.connection.privmsg_many(encoded_targets, part)
+
+        self.send_source = None
+        self.send_spool_id = None
 
     ## IRC event handlers ##
 
     # Initial events
     def on_welcome(self, conn, event):
-        conn.join(encode(self.channel))
+        latency = monotonic() - self.connect_started
+        logging.info('Registered with %s in %.2fs', self.server, latency)
+
+        self.server.succeeded(latency)
+        self.attempts = 0
+        self.registered = True
+        self.reactor.cancel(self.register_timer)
+        self.register_timer = None
+
+        for channel in self.channel_names:
+            conn.join(encode(channel))
+
+        if self.relay.spool:
+            self.reactor.call_later(self.REPLAY_DELAY, self.start_spool)
 
     def on_nicknameinuse(self, conn, event):
         target = self.target_nick
@@ -411,49 +4806,79 @@ class PyCat(SingleServerIRCBot):
         if tried == target:
             logging.warning('Trying to take back %s in 5 minutes', target)
             take_back_inuse_nick = lambda: conn.nick(encode(target))
-            self.connection.execute_delayed(60*5, take_back_inuse_nick)
+            self.reactor.call_later(60*5, take_back_inuse_nick)
 
     def on_join(self, conn, event):
         nick = conn.get_nickname()
         joiner = get_nick(event.source())
+        channel = decode(event.target())
+
+        if joiner == nick:
+            self.membership.reset(channel)
+        self.membership.join(channel, decode(joiner))
 
         if joiner == nick:
-            logging.info('%s joined %s', decode(nick), self.channel)
-        elif len(self.channels[encode(self.channel)].users()) == 1:
+            logging.info('%s joined %s on %s', decode(nick), channel,
+                self.name)
+            self.send_buffer.max_length = \
+                self.max_line_length(event.source())
+
+            if all(c in self.membership for c in self.channel_names):
+                self.start_spool()
+        elif len(self.channels[event.target()].users()) == 1:
             if not self.opfirst:
                 return
             elif self.deop:
                 mode = '+o-o+v %s %s %s' % (joiner, nick, nick)
             else:
                 mode = '+o %s' % joiner
-            conn.mode(encode(self.channel), mode)
+            conn.mode(event.target(), mode)
+
+    def on_featurelist(self, conn, event):
+        for feature in map(decode, event.arguments()):
+            if feature.startswith('CASEMAPPING='):
+                self.membership.set_casemapping(feature.split('=', 1)[1])
+            elif feature.startswith('PREFIX=') and ')' in feature:
+                self.membership.prefixes = feature.split(')', 1)[1]
+
+    def on_namreply(self, conn, event):
+        channel, names = map(decode, event.arguments()[1:3])
+        self.membership.names(channel, names)
+
+    # Membership events
+    def on_part(self, conn, event):
+        nick = decode(get_nick(event.source()))
+        channel = decode(event.target())
+
+        if nick == decode(conn.get_nickname()):
+            self.membership.remove_channel(channel)
+        else:
+            self.membership.part(channel, nick)
+
+    def on_kick(self, conn, event):
+        nick = decode(event.arguments()[0])
+        channel = decode(event.target())
+
+        if nick == decode(conn.get_nickname()):
+            self.membership.remove_channel(channel)
+        else:
+            self.membership.part(channel, nick)
+
+    def on_quit(self, conn, event):
+        self.membership.quit(decode(get_nick(event.source())))
+
+    def on_nick(self, conn, event):
+        before = decode(get_nick(event.source()))
+        self.membership.rename(before, decode(event.target()))
 
     # Regular events
     def on_pubmsg(self, conn, event):
-        if not self.script:
-            return
-
         nick = decode(conn.get_nickname())
         target = decode(event.target())
         source= decode(get_nick(event.source()))
-        message = decode(event.arguments()[0])
-        message = strip_unprintable(message)
-
-        # Can be replaced with string.Template.safe_substitute, but requires 2.4
-        match = re.sub(r'(?<!\$)\$nick', nick, self.match or '')
-        match = re.sub(r'\$\$nick', '$nick', match)
-
-        try:
-            match = re.compile(match, re.UNICODE)
-        except re.error, e:
-            logging.error('Problem with match expression: %s', e)
-            return
+        message = decode(strip_unprintable(event.arguments()[0]))
 
-        if match and not match.search(message):
-            return
-
-        self.start_process([nick, target, source, message],
-            lambda s: self.handle_stdout(s, target, source))
+        self.relay.run_script(self, nick, target, source, message)
 
     def on_privmsg(self, conn, event):
         nick = decode(conn.get_nickname())
@@ -463,7 +4888,7 @@ class PyCat(SingleServerIRCBot):
             self.on_pubmsg(conn, event)
 
     def on_mode(self, conn, event):
-        if decode(event.target()) != self.channel:
+        if not self.is_ours(decode(event.target())):
             return
 
         if not self.deop:
@@ -474,62 +4899,67 @@ class PyCat(SingleServerIRCBot):
 
         if ['+', 'o', nick] in modes:
             logging.info('%s was oped, Voicing and deoping', decode(nick))
-            conn.mode(encode(self.channel), '+v-o %s %s' % (nick, nick))
+            conn.mode(event.target(), '+v-o %s %s' % (nick, nick))
 
     def on_invite(self, conn, event):
-        if decode(event.arguments()[0]) == self.channel:
+        channel = decode(event.arguments()[0])
+
+        if self.is_ours(channel):
             nick = decode(get_nick(event.source()))
-            logging.info('Joining %s due to invite from %s',
-                self.channel, nick)
-            conn.join(encode(self.channel))
+            logging.info('Joining %s due to invite from %s', channel, nick)
+            conn.join(encode(channel))
 
     # Error events
     def on_erroneusnickname(self, conn, event):
         nick = decode(event.arguments()[0])
         logging.critical("Invalid nickname '%s', stopping bot.", nick)
-        self.running = False
+        self.relay.running = False
 
     def on_badchanmask(self, conn, event):
         channel = decode(event.arguments()[0])
         logging.critical("Invalid channel '%s', stopping bot.", channel)
-        self.running = False
+        self.relay.running = False
 
     def on_disconnect(self, conn, event):
         message = decode(event.arguments()[0])
         server = decode(event.source())
         logging.warning('Disconnected from %s: %s', server, message)
 
-        if self.irc_socket in self.dispatchers:
-            del self.dispatchers[self.irc_socket]
+        self.reactor.unregister(self.irc_socket)
+        self.membership.clear()
+        self.metrics.inc('pycat_disconnects_total', network=self.name)
 
-        self.send_buffer = []
-        self.connection.send_raw = self.send_buffer.append
+        self.send_buffer.clear()
+        self.spool_lines.clear()
+        self.relay.check_backpressure()
 
-    ## Custom connect code that overrides irclib ##
-    def _connect(self):
-        server = self.server_list[0][0]
-        port = self.server_list[0][1]
-        password = self.server_list[0][2]
+        if self.relay.spool:
+            # Whatever was queued is still spooled and will be replayed
+            self.relay.spool.stop(self.name)
 
-        logging.info('Trying to connect to %s:%s', server, port)
+        self.reactor.cancel(self.send_event)
+        self.send_event = None
 
-        try:
-            self.connect(server, port, self._nickname, password,
-                         ircname=self._realname)
-        except ServerConnectionError:
-            logging.error('Failed to connect to %s:%s', server, port)
-            return False
+        self.reactor.cancel(self.register_timer)
+        self.register_timer = None
 
-        self.irc_socket = self.connection.socket
-        self.dispatchers[self.irc_socket] = self.handle_irc
+        # Steer the next attempt away from a server that just went away
+        if self.server:
+            self.server.failed()
 
-        # Use TCP keepalive, see 'man tcp' for details about values:
-        self.irc_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, True)
-        self.irc_socket.setsockopt(socket.SOL_TCP, socket.TCP_KEEPIDLE, 150)
-        self.irc_socket.setsockopt(socket.SOL_TCP, socket.TCP_KEEPINTVL, 30)
-        self.irc_socket.setsockopt(socket.SOL_TCP, socket.TCP_KEEPCNT, 5)
+        if not self.registered:
+            self.attempts += 1
+        self.registered = False
+
+        self.schedule_reconnect()
+
+    ## Custom connect code that overrides irclib ##
+    def _connect(self):
+        self.connect_servers()
+
+    def _connected_checker(self):
+        '''Reconnects are scheduled by on_disconnect instead'''
 
-        return True
 
 class CustomHelpFormater(IndentedHelpFormatter):
     def format_epilog(self, epilog):
@@ -546,17 +4976,166 @@ def optparse():
         dest='deop', default=True, help='prevent bot from deoping itself')
     parser.add_option('--op-first', action='store_false', dest='opfirst',
         default=True, help='op first user to join channel if bot is alone')
-    parser.add_option('--listen', metavar='[addr]:port',
-        help='address to bind listener to')
+    parser.add_option('--listen', metavar='[scheme://][addr]:port',
+        default=[], action='append', help='address to bind listener to, '
+        'scheme can be tcp, udp, unix or unixgram (may be repeated)')
+    parser.add_option('--name', metavar='network',
+        help='name of the network given by the arguments, used to send to '
+        '#channel@network [default: first server]')
+    parser.add_option('--network', metavar="'name servers nickname "
+        "channels'", default=[], action='append',
+        help='connect to another network and join channels there')
+    parser.add_option('--reconnect-max', metavar='seconds', type='float',
+        default=60, help='longest wait between reconnect attempts '
+        '[default: %default]')
     parser.add_option('--realname', metavar='name',
         help='realname to provide to IRC server')
     parser.add_option('--script', metavar='path',
         help='script to send messages to')
     parser.add_option('--args', metavar='arg', default=[],
         help='extra arugments to send script', action='append')
+    parser.add_option('--route', metavar="'path regexp'", default=[],
+        help='send messages matching regexp to script at path',
+        action='append')
+    parser.add_option('--ingest-workers', metavar='count', type='int',
+        default=0, help='spread listener clients over count worker '
+        'processes sharing the listener ports [default: %default]')
+    parser.add_option('--backlog', metavar='count', type='int', default=128,
+        help='connections the kernel may hold for the listeners '
+        '[default: %default]')
+    parser.add_option('--max-clients', metavar='count', type='int',
+        default=1000, help='listener clients connected at the same time, '
+        '0 for no limit [default: %default]')
+    parser.add_option('--max-clients-per-ip', metavar='count', type='int',
+        default=0, help='listener clients from the same address, 0 for no '
+        'limit [default: %default]')
+    parser.add_option('--client-idle', metavar='seconds', type='float',
+        default=0, help='disconnect clients that send nothing for this '
+        'long, 0 to never [default: %default]')
+    parser.add_option('--client-deadline', metavar='seconds', type='float',
+        default=0, help='disconnect clients that leave a line unfinished '
+        'for this long, 0 to never [default: %default]')
+    parser.add_option('--client-max-bytes', metavar='bytes', type='int',
+        default=0, help='disconnect clients after they have sent this much, '
+        '0 for no limit [default: %default]')
+    parser.add_option('--http', metavar='[addr]:port',
+        help='accept messages as JSON over HTTP on address')
+    parser.add_option('--stats', metavar='[addr]:port',
+        help='serve metrics in Prometheus text format on address')
+    parser.add_option('--trace', metavar='path',
+        help='write trace events as JSON lines to path')
+    parser.add_option('--trace-sample', metavar='fraction', type='float',
+        default=1.0, help='fraction of trace events to write [default: '
+        '%default]')
+    parser.add_option('--profile-dir', metavar='path',
+        default=tempfile.gettempdir(), help='write profiles and debug '
+        'reports taken on SIGUSR1 to path [default: %default]')
+    parser.add_option('--profile-seconds', metavar='seconds', type='float',
+        default=30, help='how long to profile for after SIGUSR1 '
+        '[default: %default]')
+    parser.add_option('--rate', metavar='lines', type='float', default=0.5,
+        help='lines per second to send to IRC server [default: %default]')
+    parser.add_option('--burst', metavar='lines', type='int', default=5,
+        help='lines to send in a burst before throttling [default: %default]')
+    parser.add_option('--coalesce', metavar='separator',
+        help='merge queued messages to the same target using separator')
+    parser.add_option('--dedup-window', metavar='seconds', type='float',
+        default=0, help='collapse repeats of a message from the listeners '
+        'within this long into a summary, 0 to never [default: %default]')
+    parser.add_option('--dedup-mask', metavar='regexp', default=[],
+        help='ignore what regexp matches when looking for repeats (may be '
+        'repeated)', action='append')
+    parser.add_option('--queue-high', metavar='lines', type='int',
+        default=500, help='stop reading from listener clients when this '
+        'many lines are queued [default: %default]')
+    parser.add_option('--queue-low', metavar='lines', type='int',
+        default=250, help='resume reading from listener clients when the '
+        'queue is down to this many lines [default: %default]')
+    parser.add_option('--queue-limit', metavar='lines', type='int',
+        default=1000, help='queued lines before the overflow policy kicks '
+        'in [default: %default]')
+    parser.add_option('--queue-policy', type='choice',
+        choices=SendQueue.POLICIES, default='block',
+        help='overflow policy: %s [default: %%default]' %
+        ', '.join(SendQueue.POLICIES))
+    parser.add_option('--spool', metavar='dir',
+        help='keep accepted messages in dir until they have been sent')
+    parser.add_option('--spool-ttl', metavar='seconds', type='float',
+        default=3600, help='give up on spooled messages after this long, 0 '
+        'to never [default: %default]')
+    parser.add_option('--spool-sync', metavar='seconds', type='float',
+        default=1.0, help='how often to sync the spool to disk, 0 for '
+        'every message [default: %default]')
+    parser.add_option('--workers', metavar='count', type='int', default=0,
+        help='keep count script workers running in coprocess mode')
+    parser.add_option('--script-timeout', metavar='seconds', type='float',
+        default=30, help='time scripts get to reply [default: %default]')
+    parser.add_option('--max-scripts', metavar='count', type='int',
+        default=10, help='scripts to run at the same time [default: %default]')
+    parser.add_option('--script-queue', metavar='count', type='int',
+        default=50, help='requests that may wait for a free script '
+        '[default: %default]')
+    parser.add_option('--recv-size', metavar='bytes', type='int',
+        default=4096, help='bytes to read from clients and scripts at a '
+        'time [default: %default]')
+    parser.add_option('--max-line', metavar='bytes', type='int',
+        default=8192, help='split lines longer than this [default: %default]')
+    parser.add_option('--nick-rate', metavar='count/seconds',
+        help='script invocations allowed per nick')
+    parser.add_option('--channel-rate', metavar='count/seconds',
+        help='script invocations allowed per channel')
+    parser.add_option('--cache-bytes', metavar='bytes', type='int',
+        default=1024*1024, help='memory for caching script replies when the '
+        'script asks for it [default: %default]')
 
     return parser
 
+def parse_listen(string):
+    '''
+    Parse a --listen address such as 12345, [::1]:12345, udp://host:port or
+    unix:///path, returns (scheme, address) or None if it is invalid.
+    '''
+
+    scheme = 'tcp'
+    if '://' in string:
+        scheme, string = string.split('://', 1)
+
+    if scheme in ('unix', 'unixgram'):
+        return string and (scheme, string) or None
+    elif scheme not in ('tcp', 'udp'):
+        return None
+
+    match = re.match(r'^(?:(?:\[(?P<ipv6>[^\]]*)\]|(?P<host>[^:]*)):)?'
+                     r'(?P<port>\d+)$', string)
+
+    if not match:
+        return None
+
+    host = match.group('ipv6') or match.group('host') or ''
+    return scheme, (host, int(match.group('port')))
+
+def format_address(address):
+    if isinstance(address, tuple):
+        if ':' in address[0]:
+            return '[%s]:%s' % address[:2]
+        return '%s:%s' % address[:2]
+    return address
+
+def parse_servers(servers):
+    '''Parse a comma separated server list, returns None if a port is bad'''
+
+    server_list = []
+
+    # regex from http://stackoverflow.com/a/16710842
+    for addr in re.findall(r'(?:[^\s,"]|"(?:\\.|[^"])*")+', servers):
+        host, port, password = parse_host_port_password(addr)
+
+        if port == -1:
+            return None
+        server_list.append((host, port or 6667, password))
+
+    return server_list
+
 def parse_host_port_password(string, default='host'):
     password = None
     if '/' in string:
@@ -587,45 +5166,128 @@ def main():
     logging.basicConfig(level=options.debug or logging.INFO,
         format="[%(asctime)s] %(message)s")
 
-    servers, nickname, channel = args
+    networks = [[options.name] + args]
 
-    if not is_channel(channel):
-        channel = '#' + channel
+    for network in options.network:
+        if len(network.split()) != 4:
+            parser.error("--network should be given as "
+                "'name servers nickname channels'")
+        networks.append(network.split())
 
-    server_list = []
-    listen = None
-
-    # regex from http://stackoverflow.com/a/16710842
-    for addr in re.findall(r'(?:[^\s,"]|"(?:\\.|[^"])*")+', servers):
-        host, port, password = parse_host_port_password(addr)
+    for network in networks:
+        name, servers, nickname, channels = network
+        server_list = parse_servers(servers)
 
-        if port == -1:
+        if not server_list:
             parser.error('server argument got an invalid port number')
+
+        channels = channels.split(',')
+        for i, channel in enumerate(channels):
+            if not is_channel(channel):
+                channels[i] = '#' + channel
+
+        network[:] = [name or server_list[0][0], server_list, nickname,
+            channels]
+
+    names = [network[0] for network in networks]
+    if len(set(names)) != len(names):
+        parser.error('networks need unique names, see --name')
+
+    listen = []
+
+    for addr in options.listen:
+        parsed = parse_listen(addr)
+
+        if not parsed:
+            parser.error('--listen got an invalid address: %s' % addr)
+        listen.append(parsed)
+
+    stats = None
+
+    if options.stats:
+        host, port, password = parse_host_port_password(options.stats, 'port')
+
+        if port == -1 or not port:
+            parser.error('--stats got an invalid port number')
         else:
-            server_list.append((host, port or 6667, password))
+            stats = (host or '', port)
 
-    if options.listen:
-        host, port, password = parse_host_port_password(options.listen, 'port')
+    http = None
 
-        if port == -1:
-            parser.error('--listen got an invalid port number')
+    if options.http:
+        host, port, password = parse_host_port_password(options.http, 'port')
+
+        if port == -1 or not port:
+            parser.error('--http got an invalid port number')
         else:
-            listen = (host or '', port)
+            http = (host or '', port)
+
+    if options.rate <= 0:
+        parser.error('--rate should be more than 0 lines per second')
+
+    if options.burst < 1:
+        parser.error('--burst should be at least 1 line')
+
+    for name in ('nick_rate', 'channel_rate'):
+        value = getattr(options, name)
+        if value and not re.match(r'^\d+/\d+(\.\d+)?$', value):
+            parser.error('--%s should be given as count/seconds' %
+                name.replace('_', '-'))
 
     if options.script:
         script = [options.script] + options.args
     else:
         script = []
 
-    pycat = PyCat(server_list, nickname, options.realname or nickname,
-        channel, listen, script, options.deop, options.opfirst)
+    routes = []
+
+    for route in options.route:
+        if len(route.split(None, 1)) != 2:
+            parser.error("--route should be given as 'path regexp'")
+        path, match = decode(route).split(None, 1)
+        routes.append((match, [path]))
+
+    masks = map(decode, options.dedup_mask)
+
+    for mask in masks:
+        try:
+            re.compile(mask, re.UNICODE)
+        except re.error, e:
+            parser.error('--dedup-mask got an invalid regexp %s: %s' %
+                (mask, e))
+
+    if not 0 < options.trace_sample <= 1:
+        parser.error('--trace-sample should be a fraction above 0 and at '
+            'most 1')
+
+    if options.trace:
+        trace = Tracer(options.trace, options.trace_sample)
+    else:
+        trace = None
+
+    relay = Relay(listen, script, options.queue_high, options.queue_low,
+        options.workers, options.script_timeout, options.max_scripts,
+        options.script_queue, options.nick_rate, options.channel_rate,
+        options.recv_size, options.max_line, routes, trace, stats, http,
+        options.backlog, options.max_clients, options.max_clients_per_ip,
+        options.client_idle, options.client_deadline,
+        options.client_max_bytes, options.spool, options.spool_ttl,
+        options.spool_sync, options.cache_bytes, options.dedup_window,
+        masks, options.ingest_workers, options.profile_dir,
+        options.profile_seconds)
+
+    for name, server_list, nickname, channels in networks:
+        relay.add_network(PyCat(relay, name, server_list, nickname,
+            options.realname or nickname, channels, options.deop,
+            options.opfirst, options.rate, options.burst, options.coalesce,
+            options.queue_limit, options.queue_policy, options.reconnect_max))
 
     try:
-        pycat.start()
+        relay.start()
     except KeyboardInterrupt:
         pass
 
-    pycat.stop()
+    relay.stop()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,41 @@
+#! /usr/bin/python
+# Copyright (c) 2010 Thomas Kongevold Adamcik
+# Released under MIT license, see COPYING file
+
+'''
+Framing lines from a byte stream, lines longer than max_length are split
+whether or not their newline has arrived yet.
+'''
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pycat import LineFramer
+
+class LineFramerTest(unittest.TestCase):
+    def test_lines_across_reads(self):
+        framer = LineFramer(10)
+        self.assertEqual(framer.feed('abc\nde'), [u'abc'])
+        self.assertEqual(framer.feed('f\n'), [u'def'])
+
+    def test_long_line_without_newline(self):
+        framer = LineFramer(10)
+        self.assertEqual(framer.feed('abcdefghijklmno'), [u'abcdefghij'])
+        self.assertEqual(framer.feed('\n'), [u'klmno'])
+
+    def test_long_line_with_newline(self):
+        framer = LineFramer(10)
+        self.assertEqual(framer.feed('abc\ndef'), [u'abc'])
+        self.assertEqual(framer.feed('ghijklmnopqrstuvwxyz\n'),
+            [u'defghijklm', u'nopqrstuvw', u'xyz'])
+
+    def test_long_line_cut_between_characters(self):
+        framer = LineFramer(4)
+        lines = framer.feed('a\xc3\xa5\xc3\xa5\n')
+        self.assertEqual(lines, [u'a\xe5', u'\xe5'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+#! /usr/bin/python
+# Copyright (c) 2010 Thomas Kongevold Adamcik
+# Released under MIT license, see COPYING file
+
+'''
+Routing messages to scripts, the match starting earliest in the message
+wins whether or not the rules could be combined into one regexp.
+'''
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pycat import Router
+
+class RouterTest(unittest.TestCase):
+    def test_earliest_match_wins(self):
+        router = Router([('foo', ['a']), ('bb', ['b'])])
+        self.assertEqual(router.route(u'bb foo', 'cat'), ['b'])
+
+    def test_back_reference_keeps_earliest_match(self):
+        router = Router([('foo', ['a']), (r'(b)\1', ['b'])])
+        self.assertEqual(router.route(u'bb foo', 'cat'), ['b'])
+        self.assertEqual(router.route(u'foo bb', 'cat'), ['a'])
+
+    def test_first_rule_wins_at_same_position(self):
+        router = Router([(r'(b)\1', ['b']), ('bb', ['c'])])
+        self.assertEqual(router.route(u'bb', 'cat'), ['b'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#! /usr/bin/python
+# Copyright (c) 2010 Thomas Kongevold Adamcik
+# Released under MIT license, see COPYING file
+
+'''
+Spool segments on disk, checked by reopening the spool the way pycat does
+after a restart.
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pycat import Reactor, Spool
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.reactor = Reactor()
+        self.spool = self.open()
+
+    def tearDown(self):
+        self.spool.close()
+        shutil.rmtree(self.path)
+
+    def open(self):
+        return Spool(self.reactor, self.path, sync=0)
+
+    def reopen(self):
+        self.spool.close()
+        self.spool = self.open()
+
+    def segments(self):
+        return sorted(os.listdir(self.path))
+
+    def advance(self, seconds):
+        now = time.time() + seconds
+        self.addCleanup(setattr, time, 'time', time.time)
+        time.time = lambda: now
+
+    def test_ack_survives_compaction(self):
+        first, current = self.spool.append('net', ['#pycat'], u'first')
+        second, current = self.spool.append('net', ['#pycat'], u'second')
+        self.spool.rotate()
+        third, current = self.spool.append('net', ['#pycat'], u'third')
+
+        # Both acks go to the second segment, which is all sent after this
+        self.spool.ack(second)
+        self.spool.ack(third)
+        self.spool.rotate()
+
+        self.reopen()
+        self.assertEqual(sorted(self.spool.pending), [first])
+
+    def test_segments_removed_oldest_first(self):
+        first, current = self.spool.append('net', ['#pycat'], u'first')
+        self.spool.rotate()
+        second, current = self.spool.append('net', ['#pycat'], u'second')
+        self.spool.rotate()
+
+        self.spool.ack(second)
+        self.assertEqual(len(self.segments()), 3)
+
+        self.spool.ack(first)
+        self.assertEqual(len(self.segments()), 1)
+
+        self.reopen()
+        self.assertEqual(self.spool.pending, {})
+
+    def test_expired_message_does_not_pin_segments(self):
+        self.spool.ttl = 60
+        first, current = self.spool.append('net', ['#pycat'], u'first')
+        self.spool.rotate()
+        second, current = self.spool.append('net', ['#pycat'], u'second')
+        self.spool.ack(second)
+        self.spool.rotate()
+        self.assertEqual(len(self.segments()), 3)
+
+        self.advance(61)
+        self.spool.rotate()
+        self.assertEqual(len(self.segments()), 1)
+        self.assertEqual(self.spool.pending, {})
+        self.assertEqual(self.spool.expired, 1)
+
+    def test_ack_keeps_other_networks_caught_up(self):
+        self.spool.start('a')
+        self.spool.start('b')
+        first, current = self.spool.append('a', ['#pycat'], u'first')
+        self.assertTrue(current)
+
+        self.spool.ack(first)
+        self.assertTrue(self.spool.append('b', ['#pycat'], u'second')[1])
+        self.assertFalse(self.spool.append('a', ['#pycat'], u'third')[1])
+
+if __name__ == '__main__':
+    unittest.main()